@@ -184,5 +184,6 @@ all_metrics.update(compute_metrics([], n=args.n_test, datasets={"train": train_d
 all_metrics.update(compute_metrics([], n=args.n_test, datasets={"train_no_sampling": train_dataset, "test_no_sampling": test_dataset}, do_sample=False))
     
 print(all_metrics)
+print(models.generation_cache.summary())
 with open(f"{output_dir}/metrics.json", 'w') as file:
     json.dump(all_metrics, file)
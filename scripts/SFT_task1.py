@@ -123,6 +123,8 @@ all_metrics.update(compute_metrics([], datasets={"truth": unconstrained}, eval_q
 all_metrics.update(compute_metrics([], datasets={"base": test_dataset}))
 all_metrics.update(compute_metrics([], datasets={"unconstrained": unconstrained}))
 print(all_metrics)
+print(evaluation.detector.cache.summary())
+print(models.generation_cache.summary())
 
 model.config.pretraining_tp = 1
 model.config.use_cache = False
@@ -188,5 +190,6 @@ all_metrics.update(compute_metrics([], datasets={"train": train_dataset, "test":
 all_metrics.update(compute_metrics([], datasets={"train_no_sampling": train_dataset, "test_no_sampling": test_dataset}, do_sample=False))
     
 print(all_metrics)
+print(models.generation_cache.summary())
 with open(f"{output_dir}/metrics.json", 'w') as file:
     json.dump(all_metrics, file)
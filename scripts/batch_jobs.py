@@ -0,0 +1,95 @@
+import argparse
+parser = argparse.ArgumentParser(description="Runs GPT generation or quality judging of a task as an offline batch job in three steps: prepare, submit and ingest")
+parser.add_argument("step", type=str, choices=["prepare", "submit", "ingest"], help="Step of the batch job")
+parser.add_argument("--task", type=int, default=1, choices=[1, 2, 3], help="Task to run. Default: %(default)s")
+parser.add_argument("--kind", type=str, default="generate", choices=["generate", "judge"], help="Generate responses into <model>.json or judge the quality of <model>_eval.json, which is first evaluated with --skip_response_quality. Default: %(default)s")
+parser.add_argument("--model", type=str, default="gpt35", help="Model label of the files. Default: %(default)s")
+parser.add_argument("--input_file", type=str, default="test.json", help="Test set in the data directory for new generation files. Default: %(default)s")
+parser.add_argument("--n_responses", type=int, default=1, help="Number of responses. Default: %(default)s")
+parser.add_argument("--max_rows", type=int, default=100000, help="Maximum number of rows to put into the job. Default: %(default)s")
+parser.add_argument("--executor", type=str, default="openai", choices=["openai", "local", "mock"], help="Batch endpoint, local concurrent client or offline mock. Default: %(default)s")
+args = parser.parse_args()
+
+# script
+import os
+from dotenv import load_dotenv
+load_dotenv()
+os.environ['CACHE_DIR'] = os.environ['FAST_CACHE_DIR'].replace("%SLURM_JOB_ID%", os.getenv('SLURM_JOB_ID')) # speed up model loading
+import json
+import pandas as pd
+
+import sys
+sys.path.append(f'../source')
+import api
+import helpers
+
+data_dir = f'../data/task{args.task}'
+job_dir = f'{data_dir}/batch'
+os.makedirs(job_dir, exist_ok=True)
+job_name = f'{job_dir}/{args.model}_{args.kind}'
+output_file = f'{data_dir}/{args.model}.json' if args.kind == "generate" else f'{data_dir}/{args.model}_eval.json'
+prompt_functions = {1: helpers.get_generation_prompt, 2: helpers.get_prompt_task_2, 3: helpers.get_prompt_task_3}
+executors = {"openai": api.OpenAIBatchExecutor, "local": api.LocalBatchExecutor, "mock": lambda: api.LocalBatchExecutor(respond=api.mock_respond)}
+if args.kind == "judge": import evaluation
+
+def load_testset():
+    if os.path.exists(output_file): return pd.read_json(output_file)
+    if args.kind == "judge": sys.exit(f"{output_file} does not exist, run the evaluation with --skip_response_quality first")
+    testset = pd.read_json(f'{data_dir}/{args.input_file}')
+    testset['responses'] = [[]] * len(testset)
+    return testset
+
+def pending_requests(testset):
+    """
+    Requests of all rows without results, custom ids are the row index and for judging the metric
+    """
+    requests = []
+    if args.kind == "generate":
+        for idx, case in testset[testset['responses'].apply(len)==0].head(args.max_rows).iterrows():
+            messages = prompt_functions[args.task](case.copy())["messages"][:-1]
+            requests.append(api.batch_request(str(idx), messages, n=args.n_responses, temperature=0))
+    else:
+        for idx, case in testset[testset['responses'].apply(len)>0].head(args.max_rows).iterrows():
+            for metric in evaluation.gpt_metrics.keys():
+                if metric in case and pd.notna(case[metric]): continue
+                requests.append(api.batch_request(f"{idx}/{metric}", evaluation.judge_messages(metric, case['context'], case['responses'][0]), **evaluation.judge_kwargs))
+    return requests
+
+def ingest(testset, results, requests):
+    ingested = 0
+    for custom_id, completions in results.items():
+        if args.kind == "generate":
+            testset.at[int(custom_id), 'responses'] = completions
+            ingested += 1
+        else:
+            idx, metric = custom_id.split("/", 1)
+            score = evaluation.completion_to_score(completions[0])
+            if score == -1: continue # requested again by the next job
+            if metric not in testset.columns: testset[metric] = [None] * len(testset)
+            testset.at[int(idx), metric] = score
+            evaluation.judge_cache.put_many([(requests[custom_id]["body"]["messages"], evaluation.judge_kwargs, completions[0])])
+            ingested += 1
+    return ingested
+
+# logic
+testset = load_testset()
+if args.step == "prepare":
+    requests = pending_requests(testset)
+    api.write_batch_file(requests, f'{job_name}.jsonl')
+    testset.to_json(output_file)
+    print(f"Wrote {len(requests)} requests to {job_name}.jsonl")
+elif args.step == "submit":
+    batch_id = executors[args.executor]().submit(f'{job_name}.jsonl')
+    with open(f'{job_name}_batch.json', 'w') as f:
+        json.dump({"batch_id": batch_id, "executor": args.executor}, f)
+    print(f"Submitted {job_name}.jsonl as {batch_id}")
+else:
+    with open(f'{job_name}_batch.json') as f:
+        job = json.load(f)
+    executor = executors[job["executor"]]()
+    if not executor.download(job["batch_id"], f'{job_name}_results.jsonl'):
+        sys.exit(f"Batch {job['batch_id']} is {executor.status(job['batch_id'])['status']}, ingest again later")
+    requests = {request["custom_id"]: request for request in api.read_jsonl(f'{job_name}.jsonl')}
+    ingested = ingest(testset, api.read_batch_results(f'{job_name}_results.jsonl'), requests)
+    testset.to_json(output_file)
+    print(f"Ingested {ingested} of {len(requests)} requests into {output_file}, prepare again for the rest")
@@ -0,0 +1,57 @@
+# parameters
+import argparse
+parser = argparse.ArgumentParser(description="Compare the throughput of static batching and continuous batching on the plain generation of task 1")
+parser.add_argument("--input_file", type=str, default="test.json", help="Input file name in data directory. Default: %(default)s")
+parser.add_argument("--model", type=str, default="meta-llama/Meta-Llama-3-8B-Instruct", help="Huggingface Model Name. Default: %(default)s")
+parser.add_argument("--max_rows", type=int, default=64, help="Maximum number of rows to process. Default: %(default)s")
+parser.add_argument("--batch_sizes", type=int, nargs='+', default=[1, 8, 16, 32], help="Batch sizes to compare. Default: %(default)s")
+parser.add_argument("--max_new_tokens", type=int, default=128, help="Maximum number of generated tokens per case. Default: %(default)s")
+parser.add_argument("--output_file", type=str, default="../data/task1/batching_benchmark.json", help="File to save the comparison to. Default: %(default)s")
+args = parser.parse_args()
+
+# environment
+import os
+from dotenv import load_dotenv
+load_dotenv()
+os.environ['CACHE_DIR'] = os.environ['FAST_CACHE_DIR'].replace("%SLURM_JOB_ID%", os.getenv('SLURM_JOB_ID')) # speed up model loading
+
+import asyncio
+import time
+import pandas as pd
+
+import sys
+sys.path.append(f'../source')
+import helpers
+import models
+import serving
+
+model, tokenizer = models.load_generator(args.model)
+testset = pd.read_json(f'../data/task1/{args.input_file}')
+testset = testset.sample(frac=1., random_state=26).iloc[:args.max_rows]
+prompts = [helpers.get_generation_prompt(case, tokenizer.apply_chat_template, system_msg=True)['prompt'] for _, case in testset.iterrows()]
+no_memo = models.GenerationCache() # measure the generations, not the cache
+
+# logic
+results = []
+for batch_size in args.batch_sizes:
+    start = time.time()
+    static = models.generate(model, tokenizer, prompts, max_new_tokens=args.max_new_tokens, batch_size=batch_size, memo=no_memo, truncate=False)
+    static_time = time.time() - start
+
+    batcher = serving.ContinuousBatcher(model, tokenizer, max_batch_size=batch_size, max_new_tokens=args.max_new_tokens)
+    start = time.time()
+    continuous = asyncio.run(serving.generate_concurrently(batcher, prompts))
+    continuous_time = time.time() - start
+
+    static = [static] if isinstance(static, str) else static
+    results.append({"batch_size": batch_size,
+                    "static_cases_per_second": len(prompts) / static_time,
+                    "continuous_cases_per_second": len(prompts) / continuous_time,
+                    "continuous_tokens_per_second": batcher.throughput(),
+                    "speedup": static_time / continuous_time,
+                    "identical_responses": sum(a.strip() == b.strip() for a, b in zip(static, continuous)) / len(prompts)})
+    print(results[-1])
+
+report = pd.DataFrame(results).set_index("batch_size")
+print(report)
+report.to_json(args.output_file)
@@ -0,0 +1,49 @@
+# parameters
+import argparse
+parser = argparse.ArgumentParser(description="Build the lexical trigger index of the grammar detectors and report the recall it keeps")
+parser.add_argument("--dir", type=str, default="corpus_training", help="Directory of the detectors, use partial_sequences for an index passed to decoding with --triggers. Default: %(default)s")
+parser.add_argument("--output_file", type=str, default="../data/detection/trigger_index.json", help="File to save the index to. Default: %(default)s")
+parser.add_argument("--max_batches", type=int, default=100, help="Batches of corpus sentences to collect argmax tokens from. Default: %(default)s")
+parser.add_argument("--batch_size", type=int, default=256, help="Corpus sentences per batch. Default: %(default)s")
+parser.add_argument("--validation_file", type=str, default="../data/detection/corpus_validation_hits.json", help="Coded detections to report the recall on. Default: %(default)s")
+args = parser.parse_args()
+
+# environment
+from dotenv import load_dotenv
+load_dotenv()
+import os
+os.environ['CACHE_DIR'] = os.environ['FAST_CACHE_DIR'].replace("%SLURM_JOB_ID%", os.getenv('SLURM_JOB_ID')) # speed up model loading
+import pandas as pd
+import random
+from torch.utils.data import DataLoader, TensorDataset
+random.seed(os.getenv("RANDOM_SEED"))
+
+import sys
+sys.path.append(f'../source')
+import data
+import helpers
+import models
+
+# encode a sample of corpus sentences
+n = 4
+dialog_data = data.get_dialog_data()
+extracts = helpers.flatten_list_of_lists([[dialog[0][i] for i in range(n, len(dialog[0]))] for dialog in dialog_data])
+sents = [sentence for response in random.sample(extracts, min(len(extracts), args.max_batches * args.batch_size)) for sentence in data.sent_tokenize(response)]
+encoded_inputs = models.bert_tokenizer(sents, return_tensors='pt', max_length=64, padding='max_length', truncation=True)
+corpus_dataloader = DataLoader(TensorDataset(encoded_inputs['input_ids'], encoded_inputs['attention_mask']), batch_size=args.batch_size, shuffle=False)
+
+# build from the EGP examples and the corpus argmax tokens
+egp = helpers.get_egp()
+nrs = helpers.get_existing_classifiers(args.dir)
+classifiers = {nr: models.load_classifier(nr, args.dir) for nr in nrs}
+examples = {nr: data.sent_tokenize(egp[egp['#']==nr].iloc[0]['Example']) for nr in nrs}
+index = models.build_trigger_index(classifiers, examples, dataloader=corpus_dataloader, max_batches=args.max_batches, dir=args.dir)
+index.save(args.output_file)
+
+# recall against the manually coded corpus detections
+validation = pd.read_json(args.validation_file)
+validation = validation[validation['correct'] & validation['#'].isin(nrs)]
+recall = models.trigger_recall(index, list(validation['sentence']), list(validation['#']))
+report = pd.DataFrame({"recall": recall, "triggers": {nr: len(index.triggers[nr]) if index.triggers.get(nr) is not None else None for nr in recall}})
+print(report.sort_values("recall"))
+print(f"Mean recall: {report['recall'].mean():.3f}")
@@ -19,11 +19,14 @@ out_file = '../data/corpus_classification_all.pkl'
 dir="corpus_training"
 n = 4
 batch_size = 256
+trigger_file = os.getenv("TRIGGER_INDEX") # optional prefilter built with build_trigger_index.py
 
 # load data
 dialog_data = data.get_dialog_data()
 classifiers_nrs = helpers.get_existing_classifiers(dir)
 egp = helpers.get_egp()
+triggers = models.TriggerIndex.load(trigger_file) if trigger_file else None
+if triggers is not None: triggers.check(dir)
 
 # preprocess
 extracts = [[(dialog[0][i-n:i], dialog[0][i], dialog[1]) for i in range(n, len(dialog[0]))] for dialog in dialog_data]
@@ -42,10 +45,16 @@ for nr in classifiers_nrs:
     print(egp.iloc[nr-1]['Can-do statement'])
     classifier = models.load_classifier(nr, dir)
     classifier = DataParallel(classifier)
-    scores, tokens = models.score_corpus(classifier, corpus_dataloader, max_positive=1e10, max_batches=1e5, threshold=0.5)
-    results = list(zip(scores, sents))
+    positions = np.arange(len(sents))
+    dataloader = corpus_dataloader
+    if triggers is not None:
+        keep = triggers.mask(nr, encoded_inputs['input_ids'])
+        positions = positions[keep.numpy()]
+        dataloader = DataLoader(TensorDataset(encoded_inputs['input_ids'][keep], encoded_inputs['attention_mask'][keep]), batch_size=batch_size, shuffle=False)
+    scores, tokens, _ = models.score_corpus(classifier, dataloader, max_positive=1e10, max_batches=1e5, threshold=0.5)
+    results = list(zip(scores, [sents[pos] for pos in positions]))
     
-    hit_indices = np.array(indices)[np.array(scores)>0.5]
+    hit_indices = np.array(indices)[positions][np.array(scores)>0.5]
     print("{:.2f}%".format(len(np.unique(hit_indices))/len(extracts)*100))
     
     hit_sentences = [sample for score, sample in results if score > 0.5]
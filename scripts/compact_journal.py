@@ -0,0 +1,19 @@
+import argparse
+parser = argparse.ArgumentParser(description="Compacts the result journal of a generation or evaluation run into its JSON output file")
+parser.add_argument("output_file", type=str, help="Output file of the run, e.g. ../data/task1/gpt35_eval.json")
+parser.add_argument("--input_file", type=str, default="", help="Data to start from if the output file has not been written yet. Default: the output file")
+args = parser.parse_args()
+
+# script
+import os
+import pandas as pd
+
+import sys
+sys.path.append(f'../source')
+import journal
+
+store = journal.ResultJournal(args.output_file)
+testset = pd.read_json(args.output_file if os.path.exists(args.output_file) else args.input_file)
+rows = len(store.completed())
+store.compact(testset)
+print(f"Compacted {rows} rows into {args.output_file}")
@@ -0,0 +1,37 @@
+# parameters
+import argparse
+parser = argparse.ArgumentParser(description="Compare the latency and constraint satisfaction of best-of-n reranking and constrained decoding on task 1")
+parser.add_argument("--files", type=str, nargs='+', default=["best_of_n.json", "decoding.json"], help="Output files of generate_responses_task1.py --time in the data directory, one per strategy. Default: %(default)s")
+parser.add_argument("--output_file", type=str, default="best_of_n_comparison.json", help="File name in data directory to save the comparison to. Default: %(default)s")
+args = parser.parse_args()
+
+# environment
+import os
+from dotenv import load_dotenv
+load_dotenv()
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.append(f'../source')
+import evaluation
+
+# logic
+results = []
+for file in args.files:
+    testset = pd.read_json(f'../data/task1/{file}')
+    testset = testset[testset['responses'].apply(len)>0]
+    assert 'time' in testset.columns, f"{file} was generated without --time"
+    hits = evaluation.detector.satisfaction_many([responses[0] for responses in testset['responses']], list(testset['constraints']))
+    results.append({"file": file,
+                    "cases": len(testset),
+                    "time_mean": testset['time'].mean(),
+                    "time_p50": testset['time'].quantile(0.5),
+                    "time_p95": testset['time'].quantile(0.95),
+                    "satisfaction": np.mean([np.mean(case) for case in hits]),
+                    "all_satisfied": np.mean([all(case) for case in hits])})
+
+report = pd.DataFrame(results).set_index("file")
+print(report)
+report.to_json(f'../data/task1/{args.output_file}')
+print(evaluation.detector.cache.summary())
@@ -0,0 +1,27 @@
+# parameters
+import argparse
+parser = argparse.ArgumentParser(description="Compare the skipped steps and constraint satisfaction of scoring schedules for constrained decoding on task 1")
+parser.add_argument("--labels", type=str, nargs='+', required=True, help="Labels of decoding runs of generate_responses_task1.py with different --schedule settings, evaluated with evaluate_task1.py")
+parser.add_argument("--output_file", type=str, default="schedule_comparison.json", help="File name in data directory to save the comparison to. Default: %(default)s")
+args = parser.parse_args()
+
+# environment
+import numpy as np
+import pandas as pd
+
+# logic
+results = []
+for label in args.labels:
+    testset = pd.read_json(f'../data/task1/{label}_eval.json')
+    testset = testset[testset['positive_constraints'].apply(len)>0]
+    assert 'skipped_steps' in testset.columns, f"{label} was generated without --decoding"
+    results.append({"label": label,
+                    "cases": len(testset),
+                    "skipped_steps": testset['skipped_steps'].mean(),
+                    "satisfaction": np.mean([np.mean(hits) for hits in testset['positive_constraints']]),
+                    "all_satisfied": np.mean([all(hits) for hits in testset['positive_constraints']]),
+                    **({"time": testset['time'].mean()} if 'time' in testset.columns else {})})
+
+report = pd.DataFrame(results).set_index("label")
+print(report.sort_values("skipped_steps"))
+report.to_json(f'../data/task1/{args.output_file}')
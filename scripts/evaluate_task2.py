@@ -2,7 +2,11 @@ import argparse
 parser = argparse.ArgumentParser(description='Run evaluation suite for task 2.')
 parser.add_argument('--models', nargs='+', default=["gpt35"], help='List of input files')
 parser.add_argument('--skip_response_quality', action='store_true', help='Flag to evaluate quality')
+parser.add_argument('--combined_judge', action='store_true', help='Flag to judge all quality metrics of a response in one JSON completion')
+parser.add_argument('--local_judge', type=str, default='', help='Causal LM to judge the quality metrics locally from score token probabilities instead of GPT-4o')
 parser.add_argument('--max_rows', type=int, default=10, help='Maximum number of rows to process')
+parser.add_argument('--batch_size', type=int, default=32, help='Number of rows whose responses are detected and judged together. Default: %(default)s')
+parser.add_argument("--trace", action='store_true', help="Flag to trace the pipeline stages and report throughput and per-stage latencies.")
 args = parser.parse_args()
 
 # script
@@ -15,10 +19,29 @@ import sys
 sys.path.append(f'../source')
 import helpers
 import evaluation
+import tracing
+import journal
 
 import pandas as pd
 from tqdm import tqdm
 
+def get_skills(case):
+    pos_constraints = []
+    pos_categories = []
+    neg_constraints = []
+    neg_categories = []
+
+    for subcat, level in zip(case['categories'], case['levels']):
+        pos_nrs = helpers.get_preferred_nrs(subcat, level)
+        pos_constraints = pos_constraints + list(pos_nrs)
+        pos_categories = pos_categories + [f"{subcat}-{level}"] * len(pos_nrs)
+        neg_nrs, levels = helpers.get_preferred_nrs(subcat, level, harder=True, easier=False)
+        neg_constraints = neg_constraints + list(neg_nrs)
+        neg_categories = neg_categories + [f"{subcat}-{level}" for level in levels]
+    return pos_constraints, pos_categories, neg_constraints, neg_categories
+
+judge = evaluation.LocalJudge(args.local_judge) if args.local_judge else None
+
 # logic
 for model in args.models:
     input_file = f'../data/task2/{model}.json'
@@ -34,33 +57,31 @@ for model in args.models:
     else:
         testset = pd.read_json(output_file)
             
+    store = journal.ResultJournal(output_file)
+    store.apply(testset) # results of an interrupted run
     condition = (testset['responses'].apply(len)>0) & testset['Relevance'].isna()
-    subset = testset[condition]
-    max_rows = min(args.max_rows, len(subset))
-    i = 0
-    for idx, case in tqdm(subset.iterrows(), total=max_rows, desc="Responses"):
-        if i >= max_rows: break
-        i += 1
-        pos_constraints = []
-        pos_categories = []
-        neg_constraints = []
-        neg_categories = []
-        
-        for subcat, level in zip(case['categories'], case['levels']):
-            pos_nrs = helpers.get_preferred_nrs(subcat, level)
-            pos_constraints = pos_constraints + list(pos_nrs)
-            pos_categories = pos_categories + [f"{subcat}-{level}"] * len(pos_nrs)
-            neg_nrs, levels = helpers.get_preferred_nrs(subcat, level, harder=True, easier=False)
-            neg_constraints = neg_constraints + list(neg_nrs)
-            neg_categories = neg_categories + [f"{subcat}-{level}" for level in levels]
-
-        metrics = evaluation.evaluate(case['context'],
-                                      case['responses'][0],
-                                      pos_constraints,
-                                      negative_skills=neg_constraints,
-                                      evaluate_quality=not args.skip_response_quality)
-        metrics['positive_categories'] = pos_categories
-        metrics['negative_categories'] = neg_categories
-        for metric, value in metrics.items():
-            testset.at[idx, metric] = value
-        testset.to_json(output_file)
\ No newline at end of file
+    subset = testset[condition].head(args.max_rows)
+    if args.trace: tracing.tracer.enable()
+    # positive and negative constraints of a batch are detected in one encoder sweep and its judge requests run concurrently
+    for start in tqdm(range(0, len(subset), args.batch_size), desc="Batches"):
+        batch = subset.iloc[start:start+args.batch_size]
+        skills = [get_skills(case) for _, case in batch.iterrows()]
+        with tracing.tracer.case(len(batch)):
+            with tracing.span("batch"):
+                results = evaluation.evaluate_testset(list(batch['context']),
+                                                      [responses[0] for responses in batch['responses']],
+                                                      [pos_constraints for pos_constraints, _, _, _ in skills],
+                                                      [neg_constraints for _, _, neg_constraints, _ in skills],
+                                                      evaluate_quality=not args.skip_response_quality,
+                                                      combined_judge=args.combined_judge,
+                                                      judge=judge)
+            for idx, (_, pos_categories, _, neg_categories), metrics in zip(batch.index, skills, results):
+                metrics['positive_categories'] = pos_categories
+                metrics['negative_categories'] = neg_categories
+                for metric, value in metrics.items():
+                    testset.at[idx, metric] = value
+                with tracing.span("file_io"): store.append(idx, metrics)
+    with tracing.span("file_io"): store.compact(testset)
+    tracing.tracer.report(output_file.replace(".json", "_trace.json"))
+print(evaluation.detector.cache.summary())
+print(evaluation.judge_cache.summary())
\ No newline at end of file
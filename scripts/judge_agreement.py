@@ -0,0 +1,46 @@
+import argparse
+parser = argparse.ArgumentParser(description="Compares combined single-call judging or a local logprob judge to the per-metric GPT-4o scores of an evaluated file")
+parser.add_argument("--task", type=int, default=1, choices=[1, 2, 3], help="Task whose data directory holds the file. Default: %(default)s")
+parser.add_argument("--model", type=str, default="gpt35", help="Evaluated model, reads <model>_eval.json. Default: %(default)s")
+parser.add_argument("--judge", type=str, default="combined", choices=["combined", "local"], help="Judge to compare. Default: %(default)s")
+parser.add_argument("--judge_model", type=str, default="meta-llama/Meta-Llama-3-8B-Instruct", help="Causal LM of the local judge. Default: %(default)s")
+parser.add_argument("--max_rows", type=int, default=100, help="Maximum number of rows to judge again. Default: %(default)s")
+args = parser.parse_args()
+
+# script
+import os
+from dotenv import load_dotenv
+load_dotenv()
+os.environ['CACHE_DIR'] = os.environ['FAST_CACHE_DIR'].replace("%SLURM_JOB_ID%", os.getenv('SLURM_JOB_ID')) # speed up model loading
+import json
+import numpy as np
+import pandas as pd
+from scipy.stats import spearmanr
+
+import sys
+sys.path.append(f'../source')
+import evaluation
+
+input_file = f'../data/task{args.task}/{args.model}_eval.json'
+output_file = f'../data/task{args.task}/{args.model}_{args.judge}_judge_agreement.json'
+
+testset = pd.read_json(input_file)
+judged = testset[(testset['responses'].apply(len)>0) & testset['Relevance'].notna()].head(args.max_rows)
+judge = evaluation.LocalJudge(args.judge_model) if args.judge == "local" else None
+rejudged = evaluation.get_response_quality_many(list(judged['context']), [responses[0] for responses in judged['responses']], combined=args.judge == "combined", judge=judge)
+
+report = {"rows": len(judged), **(evaluation.combined_stats if judge is None else {})}
+for metric in evaluation.gpt_metrics.keys():
+    single = judged[metric].astype(float).to_numpy()
+    joint = np.array([quality[metric] for quality in rejudged])
+    report[metric] = {"exact": float(np.mean(single == np.round(joint))),
+                      "within_1": float(np.mean(np.abs(single - joint) <= 1)),
+                      "mean_difference": float(np.mean(joint - single)),
+                      "spearman": float(spearmanr(single, joint).correlation)}
+    print(f"{metric:>25}: exact={report[metric]['exact']:.2f} within_1={report[metric]['within_1']:.2f} mean_difference={report[metric]['mean_difference']:+.2f} spearman={report[metric]['spearman']:.2f}")
+if judge is None:
+    print(f"{report['fallbacks']} metrics fell back to individual calls for {report['calls']} combined calls")
+    print(evaluation.judge_cache.summary())
+
+with open(output_file, 'w') as f:
+    json.dump(report, f, indent=2)
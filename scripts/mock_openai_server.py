@@ -0,0 +1,61 @@
+import argparse
+parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI chat completions endpoint to test the judge client without paying for requests")
+parser.add_argument("--port", type=int, default=8000, help="Port to listen on. Default: %(default)s")
+parser.add_argument("--latency", type=float, default=0.5, help="Mean response latency in seconds. Default: %(default)s")
+parser.add_argument("--rate_limit_rate", type=float, default=0.05, help="Fraction of requests answered with 429. Default: %(default)s")
+parser.add_argument("--error_rate", type=float, default=0.02, help="Fraction of requests answered with 500. Default: %(default)s")
+parser.add_argument("--content", type=str, default="", help="Fixed completion content. Default: a random score from 1 to 5")
+parser.add_argument("--echo", action="store_true", help="Answer with the content of the last message to check that results keep the order of the requests")
+args = parser.parse_args()
+
+# script
+# run with OPENAI_BASE_URL=http://localhost:8000/v1 in the environment of the evaluation scripts
+import json
+import random
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+stats = {"requests": 0, "rate_limited": 0, "errors": 0}
+
+class ChatCompletionHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, body, headers={}):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in headers.items(): self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or "{}")
+        stats["requests"] += 1
+        time.sleep(random.expovariate(1 / args.latency) if args.latency > 0 else 0)
+        draw = random.random()
+        if draw < args.rate_limit_rate:
+            stats["rate_limited"] += 1
+            return self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests"}}, {"retry-after": "1"})
+        if draw < args.rate_limit_rate + args.error_rate:
+            stats["errors"] += 1
+            return self.send_json(500, {"error": {"message": "Internal server error", "type": "server_error"}})
+        n = request.get("n", 1)
+        prompt_tokens = sum(len(message["content"]) for message in request.get("messages", [])) // 4
+        content = lambda: args.content or str(random.randint(1, 5))
+        if args.echo: content = lambda: request["messages"][-1]["content"]
+        elif request.get("response_format", {}).get("type") == "json_object": # answer with a score for every quoted key of the system prompt
+            keys = re.findall(r'"([^"]+)"', request["messages"][0]["content"])
+            content = lambda: args.content or json.dumps({key: random.randint(1, 5) for key in keys})
+        choices = [{"index": i, "message": {"role": "assistant", "content": content()}, "finish_reason": "stop", "logprobs": None} for i in range(n)]
+        self.send_json(200, {"id": f"chatcmpl-{stats['requests']}", "object": "chat.completion", "created": int(time.time()), "model": request.get("model", "mock"),
+                             "choices": choices, "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": n, "total_tokens": prompt_tokens + n}})
+
+    def log_message(self, format, *log_args):
+        pass
+
+server = ThreadingHTTPServer(("localhost", args.port), ChatCompletionHandler)
+print(f"Serving chat completions on http://localhost:{args.port}/v1")
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    print(stats)
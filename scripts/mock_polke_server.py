@@ -0,0 +1,55 @@
+import argparse
+parser = argparse.ArgumentParser(description="Local stand-in for the POLKE extractor to test the annotation client")
+parser.add_argument("--port", type=int, default=8001, help="Port to listen on. Default: %(default)s")
+parser.add_argument("--latency", type=float, default=0.2, help="Mean response latency in seconds. Default: %(default)s")
+parser.add_argument("--error_rate", type=float, default=0.05, help="Fraction of requests answered with 503. Default: %(default)s")
+args = parser.parse_args()
+
+# script
+# pass api_url="http://localhost:8001" to api.PolkeClient or api.get_annotations
+import json
+import random
+import re
+import time
+import hashlib
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+stats = {"requests": 0, "errors": 0}
+
+def annotate(text):
+    """
+    Deterministic fake annotations, every word gets a construct id derived from its hash
+    """
+    return [{"constructID": int(hashlib.md5(match.group(0).lower().encode()).hexdigest(), 16) % 1200 + 1, "begin": match.start(), "end": match.end()}
+            for match in re.finditer(r"\w+", text)]
+
+class ExtractorHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/extractor": return self.send_json(404, {"error": "not found"})
+        stats["requests"] += 1
+        time.sleep(random.expovariate(1 / args.latency) if args.latency > 0 else 0)
+        if random.random() < args.error_rate:
+            stats["errors"] += 1
+            return self.send_json(503, {"error": "service unavailable"})
+        text = parse_qs(url.query).get("text", [""])[0]
+        self.send_json(200, {"annotationList": annotate(text)})
+
+    def log_message(self, format, *log_args):
+        pass
+
+server = ThreadingHTTPServer(("localhost", args.port), ExtractorHandler)
+print(f"Serving the extractor on http://localhost:{args.port}")
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    print(stats)
@@ -6,6 +6,8 @@ parser.add_argument("--n", type=int, default=100, help="Number of responses to s
 parser.add_argument('--decoding', action='store_true', help='Flag to use the decoding strategy')
 parser.add_argument('--reflexive', action='store_true', help='Flag to check all reflexive primes')
 parser.add_argument('--level', action='store_true', help='Flag to use CEFR level prompt')
+parser.add_argument("--max_batch_size", type=int, default=64, help="Maximum number of responses generated in one sampling round. Default: %(default)s")
+parser.add_argument("--max_attempts", type=int, default=None, help="Maximum number of responses generated per prime construct, 4*n if not given. Default: %(default)s")
 parser.add_argument("--start_from", type=int, default=0, help="Index of existing output file to start generating from. Default: %(default)s")
 args = parser.parse_args()
 
@@ -14,6 +16,8 @@ load_dotenv()
 import os
 os.environ['CACHE_DIR'] = os.environ['FAST_CACHE_DIR'].replace("%SLURM_JOB_ID%", os.getenv('SLURM_JOB_ID')) # speed up model loading
 
+import math
+import json
 import pandas as pd
 import sys
 sys.path.append(f'../source')
@@ -29,6 +33,7 @@ classifiers = {nr: models.load_classifier(nr, "corpus_training") for nr in skill
 primed_file ='../data/prime_stats.json'
 generations_file = f"../data/intervention/{args.generations_file}.json"
 output_path = f"../data/intervention/{args.output_file}.json"
+acceptance_path = f"../data/intervention/{args.output_file}_acceptance.json"
 
 all_stats = pd.read_json(primed_file)
 alpha = 0.05 / len(all_stats)
@@ -36,17 +41,60 @@ print(alpha)
 diff_thres = 0.05
 batch_size = 8
 
-def sample_successful(constraint, n=batch_size):
-    cases = pd.DataFrame([helpers.sample_dialog_snippet(dialogs) for _ in range(n)])
-    cases.columns = ['context','response','source','id']
-    cases['constraints'] = [[constraint]] * n
-    cases = cases.apply(lambda x: helpers.get_generation_prompt(x, tokenizer.apply_chat_template, system_msg=True), axis=1)
-    classifiers = {nr: models.load_classifier(nr, "partial_sequences") for nr in [constraint]}
-    cases['response'] = [models.decoding(model, tokenizer, prompt, constrained=args.decoding, classifiers=classifiers, alpha=0.95) for prompt in cases['prompt']]
-    success = (models.probe_model(classifiers[constraint], list(cases['response']))[0] > 0.5).numpy()
-    return cases[success]
+class RejectionSampler():
+    """
+    Generates responses primed for a construct in rounds and keeps those its detector accepts, each round is sized with the acceptance rate estimated so far to reach the target count
+    """
+    def __init__(self, constraint, min_batch_size=batch_size, max_batch_size=64, max_attempts=400, margin=1.2):
+        self.constraint = constraint
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.max_attempts = max_attempts
+        self.margin = margin
+        self.classifier = models.load_classifier(constraint, "partial_sequences")
+        self.attempts, self.accepted, self.rounds = 0, 0, 0
 
+    def acceptance_rate(self):
+        """
+        Posterior mean of the acceptance rate under a uniform prior
+        """
+        return (self.accepted + 1) / (self.attempts + 2)
 
+    def next_batch_size(self, missing):
+        size = math.ceil(self.margin * missing / self.acceptance_rate())
+        return min(max(self.min_batch_size, min(size, self.max_batch_size)), self.max_attempts - self.attempts)
+
+    def generate(self, prompts):
+        if not args.decoding:
+            responses = models.generate(model, tokenizer, prompts, batch_size=len(prompts), truncate=False) # like decoding, prompts are neither cut nor padded to 512 tokens
+            return [responses] if isinstance(responses, str) else responses
+        classifiers = {self.constraint: self.classifier}
+        return [models.decoding(model, tokenizer, prompt, constrained=True, classifiers=classifiers, alpha=0.95) for prompt in prompts]
+
+    def sample_round(self, n):
+        cases = pd.DataFrame([helpers.sample_dialog_snippet(dialogs) for _ in range(n)])
+        cases.columns = ['context','response','source','id']
+        cases['constraints'] = [[self.constraint]] * n
+        cases = cases.apply(lambda x: helpers.get_generation_prompt(x, tokenizer.apply_chat_template, system_msg=True), axis=1)
+        cases['response'] = self.generate(list(cases['prompt']))
+        success = (models.probe_model(self.classifier, list(cases['response']))[0] > 0.5).numpy()
+        self.attempts += n
+        self.accepted += int(success.sum())
+        self.rounds += 1
+        return cases[success]
+
+    def sample(self, n):
+        """
+        Accepted cases until n are reached or the attempts are used up
+        """
+        accepted = []
+        while self.accepted < n and self.attempts < self.max_attempts:
+            accepted.append(self.sample_round(self.next_batch_size(n - self.accepted)))
+            print(f"round {self.rounds}: {self.accepted}/{n} accepted of {self.attempts} attempts, acceptance rate {self.acceptance_rate():.2f}")
+        return pd.concat(accepted, ignore_index=True) if accepted else pd.DataFrame(columns=['constraints'])
+
+    def summary(self):
+        return {"attempts": self.attempts, "accepted": self.accepted, "rounds": self.rounds, "acceptance_rate": self.accepted / self.attempts if self.attempts else None}
 
 condition = (all_stats['p']<alpha) & (all_stats['p1-p2']>diff_thres)
 if args.reflexive: condition = condition | (all_stats['prime']==all_stats['target'])
@@ -60,19 +108,26 @@ for level in levels:
 relevant = pd.read_json(output_path) if os.path.exists(output_path) else relevant
 
 all_cases = pd.read_json(generations_file) if os.path.exists(generations_file) else pd.DataFrame(columns=['constraints'])
+acceptance = {}
+if os.path.exists(acceptance_path):
+    with open(acceptance_path) as f:
+        acceptance = json.load(f)
 
 for prime_nr in relevant['prime'].unique():
     print(prime_nr)
     cases = all_cases[all_cases['constraints'].isin([[prime_nr]])]
-    attempts = 0
-    while len(cases) < args.n and attempts < 4 * args.n // batch_size:
-        new_cases = sample_successful(prime_nr)
+    if len(cases) < args.n:
+        sampler = RejectionSampler(prime_nr, max_batch_size=args.max_batch_size, max_attempts=args.max_attempts if args.max_attempts else 4 * args.n)
+        new_cases = sampler.sample(args.n - len(cases))
         for response in new_cases['response']:
             print(response)
         all_cases = pd.concat([all_cases, new_cases], ignore_index=True)
         cases = pd.concat([cases, new_cases], ignore_index=True)
-        attempts += 1
-        print(len(cases))
+        acceptance[str(prime_nr)] = sampler.summary()
+        with open(acceptance_path, 'w') as f:
+            json.dump(acceptance, f, indent=2)
+        print(f"{prime_nr}: {sampler.summary()}")
+    cases = cases.head(args.n)
     if not len(cases): continue
     
     all_cases.to_json(generations_file) # save generated responses for further use
@@ -108,3 +163,5 @@ for prime_nr in relevant['prime'].unique():
             relevant.loc[prime & target, f'num_success'] = generate_evaluate(cases)
             
     relevant.reset_index(drop=True).to_json(output_path)
+
+print(models.generation_cache.summary())
@@ -0,0 +1,46 @@
+# parameters
+import argparse
+parser = argparse.ArgumentParser(description="Replay recorded constrained decoding of task 1 for several alphas")
+parser.add_argument("--record_file", type=str, required=True, help="Decoding record created with generate_responses_task1.py --record_file")
+parser.add_argument("--alphas", type=float, nargs='+', default=[0., 0.9, 0.95, 0.99, 0.999, 0.9999, 1.], help="Values of alpha to decode with. Default: %(default)s")
+parser.add_argument("--input_file", type=str, default="test.json", help="Input file name in data directory. Default: %(default)s")
+parser.add_argument("--model", type=str, default="meta-llama/Meta-Llama-3-8B-Instruct", help="Huggingface Model Name. Default: %(default)s")
+parser.add_argument("--max_rows", type=int, default=10, help="Maximum number of rows to process. Default: %(default)s")
+args = parser.parse_args()
+
+# environment
+import os
+from dotenv import load_dotenv
+load_dotenv()
+os.environ['CACHE_DIR'] = os.environ['FAST_CACHE_DIR'].replace("%SLURM_JOB_ID%", os.getenv('SLURM_JOB_ID')) # speed up model loading
+
+from tqdm import tqdm
+import pandas as pd
+import time
+
+import sys
+sys.path.append(f'../source')
+import helpers
+import models
+
+model, tokenizer = models.load_generator(args.model)
+record = models.DecodingRecord(args.record_file)
+testset = pd.read_json(f'../data/task1/{args.input_file}')
+testset = testset.sample(frac=1., random_state=26).iloc[:args.max_rows]
+
+# logic
+for alpha in args.alphas:
+    label = f"{alpha:g}".replace(".", "")
+    output = testset.copy()
+    output['responses'] = [[]] * len(output)
+    output['time'] = [0.] * len(output)
+    recorded = len(record.steps)
+    for idx, case in tqdm(output.iterrows(), total=len(output), desc=f"alpha={alpha}"):
+        case = helpers.get_generation_prompt(case, tokenizer.apply_chat_template, system_msg=True)
+        classifiers = {nr: models.load_classifier(nr, "partial_sequences") for nr in case['constraints']}
+        start = time.time()
+        output.at[idx, 'responses'] = [models.replay_decoding(model, tokenizer, case['prompt'], alpha, record, constrained=True, classifiers=classifiers, **(record.config or {}))]
+        output.at[idx, 'time'] = time.time() - start
+    print(f"alpha={alpha}: {len(record.steps) - recorded} new decoding steps computed")
+    output.to_json(f'../data/task1/decoding-{label}.json')
+    record.save()
@@ -0,0 +1,36 @@
+# parameters
+import argparse
+parser = argparse.ArgumentParser(description="Distill grammar detectors into probes on the hidden states of a generator")
+parser.add_argument("--model", type=str, default="meta-llama/Meta-Llama-3-8B-Instruct", help="Huggingface Model Name. Default: %(default)s")
+parser.add_argument("--teacher_dir", type=str, default="partial_sequences", help="Directory of the detectors to distill. Default: %(default)s")
+parser.add_argument("--output_dir", type=str, default="hidden_probes", help="Directory in models to save the probes to. Default: %(default)s")
+parser.add_argument("--n_texts", type=int, default=2000, help="Number of dialog utterances to distill on. Default: %(default)s")
+parser.add_argument("--num_epochs", type=int, default=3, help="Number of training epochs. Default: %(default)s")
+args = parser.parse_args()
+
+# environment
+from dotenv import load_dotenv
+load_dotenv()
+import os
+os.environ['CACHE_DIR'] = os.environ['FAST_CACHE_DIR'].replace("%SLURM_JOB_ID%", os.getenv('SLURM_JOB_ID')) # speed up model loading
+import random
+random.seed(os.getenv("RANDOM_SEED"))
+
+import sys
+sys.path.append(f'../source')
+import data
+import helpers
+import models
+
+# load data and models
+model, tokenizer = models.load_generator(args.model)
+nrs = helpers.get_existing_classifiers(args.teacher_dir)
+teachers = {nr: models.load_classifier(nr, args.teacher_dir) for nr in nrs}
+utterances = helpers.flatten_list_of_lists([dialog for dialog, source, id in data.get_dialog_data()])
+texts = random.sample(utterances, min(args.n_texts, len(utterances)))
+
+# distill and save
+probes = models.distill_probes(model, tokenizer, teachers, texts, num_epochs=args.num_epochs)
+os.makedirs(f'../models/{args.output_dir}', exist_ok=True)
+for nr, probe in probes.items():
+    models.save_probe(probe, nr, args.output_dir)
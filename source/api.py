@@ -3,11 +3,24 @@
 from dotenv import load_dotenv
 import os
 load_dotenv()
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, APIStatusError, APIConnectionError
 import requests
+import asyncio
+import random
+import time
+import json
+import re
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from collections import deque
+import tracing
 
 # OpenAI API
 client = OpenAI()
+@tracing.traced("openai_call")
 def get_openai_chat_completion(messages, model=os.getenv("OPENAI_DEFAULT_MODEL"), n=1, temperature=1, max_tokens=128):
     response = client.chat.completions.create(
         model=model,
@@ -21,14 +34,256 @@ def get_openai_chat_completion(messages, model=os.getenv("OPENAI_DEFAULT_MODEL")
     )
     return [choice.message.content for choice in response.choices]
 
+def estimate_tokens(messages, max_tokens):
+    return sum(len(message["content"]) for message in messages) // 4 + max_tokens
+
+class RateLimiter():
+    """
+    Sliding one-minute windows over the requests and tokens sent to the API
+    """
+    def __init__(self, rpm=500, tpm=30000):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.events = deque() # (time, tokens)
+        self.tokens = 0
+
+    async def acquire(self, tokens):
+        tokens = min(tokens, self.tpm)
+        while True:
+            now = time.monotonic()
+            while self.events and now - self.events[0][0] >= 60:
+                self.tokens -= self.events.popleft()[1]
+            if len(self.events) < self.rpm and self.tokens + tokens <= self.tpm:
+                self.events.append((now, tokens))
+                self.tokens += tokens
+                return
+            await asyncio.sleep(60 - (now - self.events[0][0]))
+
+class AsyncChatClient():
+    """
+    Sends many chat completion requests concurrently with a bounded pool, rate limits and exponential backoff on 429 and 5xx responses, results keep the order of the requests
+    """
+    def __init__(self, max_concurrency=16, rpm=500, tpm=30000, max_retries=6, base_delay=1., max_delay=60., **client_kwargs):
+        self.client_kwargs = client_kwargs # OPENAI_BASE_URL points the client to a local stand-in server
+        self.max_concurrency = max_concurrency
+        self.limiter = RateLimiter(rpm, tpm)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = {"requests": 0, "retries": 0, "failures": 0}
+
+    def backoff(self, attempt, error):
+        retry_after = getattr(error, "response", None) is not None and error.response.headers.get("retry-after")
+        if retry_after: return float(retry_after)
+        return min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.)
+
+    async def chat_completion(self, client, semaphore, messages, model=os.getenv("OPENAI_DEFAULT_MODEL"), n=1, temperature=1, max_tokens=128, **kwargs):
+        async with semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self.limiter.acquire(estimate_tokens(messages, max_tokens) * n)
+                self.stats["requests"] += 1
+                try:
+                    response = await client.chat.completions.create(model=model, messages=messages, temperature=temperature, max_tokens=max_tokens, top_p=1, frequency_penalty=0, presence_penalty=0, n=n, **kwargs)
+                    return [choice.message.content for choice in response.choices]
+                except (APIStatusError, APIConnectionError) as error:
+                    if isinstance(error, APIStatusError) and error.status_code != 429 and error.status_code < 500: raise
+                    if attempt == self.max_retries: break
+                    self.stats["retries"] += 1
+                    await asyncio.sleep(self.backoff(attempt, error))
+        self.stats["failures"] += 1
+        print(f"Error: Request failed after {self.max_retries} retries")
+        return [""] * n
+
+    async def chat_completions(self, requests):
+        client = AsyncOpenAI(max_retries=0, **self.client_kwargs)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        try:
+            return await asyncio.gather(*[self.chat_completion(client, semaphore, **request) for request in requests])
+        finally:
+            await client.close()
+
+    def run(self, requests):
+        """
+        Takes a list of keyword dicts for get_openai_chat_completion and returns the list of completions in the same order
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.chat_completions(requests))
+        with ThreadPoolExecutor(max_workers=1) as executor: # a loop is already running, e.g. in Jupyter, so the requests get their own loop in a worker thread
+            return executor.submit(asyncio.run, self.chat_completions(requests)).result()
+
+# Batch jobs
+def batch_request(custom_id, messages, model=os.getenv("OPENAI_DEFAULT_MODEL"), n=1, temperature=1, max_tokens=128, **kwargs):
+    """
+    One line of a batch job file, the custom id maps the result back to its row
+    """
+    return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+            "body": {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens, "top_p": 1, "frequency_penalty": 0, "presence_penalty": 0, "n": n, **kwargs}}
+
+def write_batch_file(requests, path):
+    with open(path, 'w') as f:
+        for request in requests:
+            f.write(json.dumps(request) + "\n")
+
+def read_jsonl(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def read_batch_results(path):
+    """
+    Maps custom ids to the completions of successful requests, failed requests are left out to be submitted again
+    """
+    results = {}
+    for line in read_jsonl(path):
+        response = line.get("response") or {}
+        if line.get("error") is None and response.get("status_code") == 200:
+            results[line["custom_id"]] = [choice["message"]["content"] for choice in response["body"]["choices"]]
+    return results
+
+class OpenAIBatchExecutor():
+    """
+    Submits job files to the batch endpoint and downloads the results once the job is completed
+    """
+    def __init__(self, base_url=None, api_key=None, completion_window="24h"):
+        self.base_url = (base_url or os.getenv("OPENAI_BASE_URL") or "https://api.openai.com/v1").rstrip("/")
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {api_key or os.getenv('OPENAI_API_KEY')}"
+        self.completion_window = completion_window
+
+    def submit(self, input_path):
+        with open(input_path, 'rb') as f:
+            upload = self.session.post(f"{self.base_url}/files", files={"file": f}, data={"purpose": "batch"}, timeout=600)
+        upload.raise_for_status()
+        batch = self.session.post(f"{self.base_url}/batches", json={"input_file_id": upload.json()["id"], "endpoint": "/v1/chat/completions", "completion_window": self.completion_window}, timeout=60)
+        batch.raise_for_status()
+        return batch.json()["id"]
+
+    def status(self, batch_id):
+        response = self.session.get(f"{self.base_url}/batches/{batch_id}", timeout=60)
+        response.raise_for_status()
+        return response.json()
+
+    def download(self, batch_id, output_path):
+        """
+        Writes the results of a completed job and returns False while it is still running
+        """
+        batch = self.status(batch_id)
+        if batch["status"] != "completed": return False
+        with open(output_path, 'w') as f:
+            for file_id in [batch.get("output_file_id"), batch.get("error_file_id")]:
+                if not file_id: continue
+                response = self.session.get(f"{self.base_url}/files/{file_id}/content", timeout=600)
+                response.raise_for_status()
+                f.write(response.text)
+        return True
+
+class LocalBatchExecutor():
+    """
+    Runs job files on the machine through the concurrent client, or through a response function for offline tests, results use the format of the batch endpoint
+    """
+    def __init__(self, respond=None, **client_kwargs):
+        self.respond = respond
+        self.client_kwargs = client_kwargs
+
+    def submit(self, input_path):
+        """
+        Runs the job right away, the batch id is the path of its results
+        """
+        lines = read_jsonl(input_path)
+        if self.respond:
+            completions = [[self.respond(line["body"]) for _ in range(line["body"].get("n", 1))] for line in lines]
+        else:
+            request_kwargs = lambda body: {key: value for key, value in body.items() if key not in ("top_p", "frequency_penalty", "presence_penalty")}
+            completions = AsyncChatClient(**self.client_kwargs).run([request_kwargs(line["body"]) for line in lines])
+        batch_id = input_path.replace(".jsonl", "_local_results.jsonl")
+        write_batch_file([{"id": f"local_{i}", "custom_id": line["custom_id"], "error": None,
+                           "response": {"status_code": 200, "body": {"choices": [{"index": j, "message": {"role": "assistant", "content": content}} for j, content in enumerate(contents)]}}}
+                          for i, (line, contents) in enumerate(zip(lines, completions)) if all(content != "" for content in contents)], batch_id)
+        return batch_id
+
+    def status(self, batch_id):
+        return {"id": batch_id, "status": "completed" if os.path.exists(batch_id) else "failed"}
+
+    def download(self, batch_id, output_path):
+        if batch_id != output_path: shutil.copyfile(batch_id, output_path)
+        return True
+
+def mock_respond(body):
+    """
+    Offline stand-in for the model, answers a random score or a JSON object of scores in JSON mode
+    """
+    if body.get("response_format", {}).get("type") == "json_object":
+        return json.dumps({key: random.randint(1, 5) for key in re.findall(r'"([^"]+)"', body["messages"][0]["content"])})
+    return str(random.randint(1, 5))
+
 # Polke API
+class PolkeClient():
+    """
+    Annotates texts over a persistent keep-alive session with a bounded pool of workers, retries with backoff and timeouts and an on-disk cache keyed by text hash
+    """
+    def __init__(self, api_url="http://polke.kibi.group", max_workers=8, timeout=30, max_retries=4, base_delay=1., cache_dir=os.getenv("POLKE_CACHE") or None):
+        self.api_url = api_url
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.cache_dir = cache_dir
+        if cache_dir: os.makedirs(cache_dir, exist_ok=True)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "retries": 0, "cache_hits": 0}
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def cache_path(self, text):
+        return os.path.join(self.cache_dir, hashlib.sha256(f"{self.api_url}\n{text}".encode()).hexdigest() + ".json")
+
+    def request(self, text):
+        for attempt in range(self.max_retries + 1):
+            self.count("requests")
+            try:
+                response = self.session.post(f"{self.api_url}/extractor", params={'text': text}, timeout=self.timeout)
+                if response.status_code != 429 and response.status_code < 500:
+                    response.raise_for_status()
+                    return response.json()
+                error = requests.HTTPError(f"Received status code {response.status_code}", response=response)
+            except (requests.ConnectionError, requests.Timeout) as connection_error:
+                error = connection_error
+            if attempt == self.max_retries: raise error
+            self.count("retries")
+            time.sleep(self.base_delay * 2 ** attempt * random.uniform(0.5, 1.))
+
+    def annotate(self, text):
+        if self.cache_dir and os.path.exists(self.cache_path(text)):
+            self.count("cache_hits")
+            with open(self.cache_path(text)) as f:
+                response_json = json.load(f)
+        else:
+            response_json = self.request(text)
+            if self.cache_dir:
+                path = self.cache_path(text)
+                with open(f"{path}.{threading.get_ident()}.tmp", 'w') as f:
+                    json.dump(response_json, f)
+                os.replace(f"{path}.{threading.get_ident()}.tmp", path)
+        return set((annotation['constructID'], annotation['begin'], annotation['end']) for annotation in response_json.get("annotationList", []))
+
+    def annotate_many(self, texts, progress=True):
+        """
+        Annotates texts concurrently with at most max_workers requests in flight, duplicates are requested once and results keep the order of the texts
+        """
+        unique = list(dict.fromkeys(texts))
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            annotations = dict(zip(unique, tqdm(executor.map(self.annotate, unique), total=len(unique), desc="Annotate", disable=not progress)))
+        return [annotations[text] for text in texts]
+
+polke_clients = {}
+@tracing.traced("polke_call")
 def get_annotations(text, api_url="http://polke.kibi.group"):
-    response = requests.post(f"{api_url}/extractor", params={'text': text})
-
-    if response.status_code == 200:
-        response_json = response.json()
-        annotation_tuples = [(annotation['constructID'], annotation['begin'], annotation['end']) for annotation in response_json.get("annotationList", [])]
-        return set(annotation_tuples)
-    else:
-        print(f"Error: Received status code {response.status_code}")
-        return set()
\ No newline at end of file
+    if api_url not in polke_clients: polke_clients[api_url] = PolkeClient(api_url)
+    return polke_clients[api_url].annotate(text)
@@ -9,14 +9,22 @@ nltk.download("punkt", download_dir=os.getenv('CACHE_DIR'))
 nltk.data.path.insert(0, os.getenv('CACHE_DIR'))
 from nltk.util import ngrams
 import re
+import sqlite3
+import hashlib
+import json
+from collections import OrderedDict
 import numpy as np
 from tqdm import tqdm
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
 
 import sys
 sys.path.append('../source')
 import models
 import helpers
 import api
+import tracing
 
 def calculate_distinct_n(texts, n=2):
     if isinstance(texts, str): texts = [texts]
@@ -26,26 +34,137 @@ def calculate_distinct_n(texts, n=2):
     total_n_grams = len(n_grams)
     return unique_n_grams / total_n_grams if total_n_grams > 0 else 0
 
+def normalize_sentence(sentence):
+    return re.sub(r"\s+", " ", sentence.strip()).lower() # the detectors use an uncased tokenizer
+
+def weights_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+class DetectionCache():
+    """
+    Two-tier memo of detector results, an in-process LRU in front of an optional SQLite table, keyed by normalized sentence, detector directory, construct and detector weights hash
+    """
+    schema_version = 2
+
+    def __init__(self, path=None, max_entries=100000):
+        self.memory = OrderedDict()
+        self.max_entries = max_entries
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, timeout=30)
+            self.migrate()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    def migrate(self):
+        """
+        Stores of the first schema do not record the detector directory and are dropped
+        """
+        with self.db:
+            if self.db.execute("PRAGMA user_version").fetchone()[0] < self.schema_version:
+                self.db.execute("DROP TABLE IF EXISTS detections")
+                self.db.execute(f"PRAGMA user_version={self.schema_version}")
+            self.db.execute("CREATE TABLE IF NOT EXISTS detections (sentence TEXT, dir TEXT, nr TEXT, weights TEXT, score REAL, token TEXT, PRIMARY KEY (sentence, dir, nr, weights))")
+
+    def purge(self, dir, versions):
+        """
+        Deletes results of the directory's detectors whose weights changed since they were stored, detectors of other directories sharing the store are kept
+        """
+        if self.db is None: return
+        with self.db:
+            self.db.executemany("DELETE FROM detections WHERE dir=? AND nr=? AND weights!=?", [(dir, str(nr), weights) for nr, weights in versions.items()])
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.stats["memory_hits"] += 1
+            return self.memory[key]
+        if self.db is not None:
+            row = self.db.execute("SELECT score, token FROM detections WHERE sentence=? AND dir=? AND nr=? AND weights=?", key).fetchone()
+            if row is not None:
+                self.stats["disk_hits"] += 1
+                self.remember(key, row)
+                return row
+        self.stats["misses"] += 1
+        return None
+
+    def remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def put_many(self, items):
+        for key, value in items: self.remember(key, value)
+        if self.db is not None:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?, ?, ?)", [(*key, *value) for key, value in items])
+
+    def hit_rate(self):
+        lookups = sum(self.stats.values())
+        return (self.stats["memory_hits"] + self.stats["disk_hits"]) / lookups if lookups else 0.
+
+    def summary(self):
+        return f"Detection cache: {self.hit_rate():.1%} hit rate ({self.stats['memory_hits']} memory, {self.stats['disk_hits']} disk, {self.stats['misses']} misses)"
+
 class GrammarDetection():
-    def __init__(self, dir="corpus_training", skill_nrs=None):
+    def __init__(self, dir="corpus_training", skill_nrs=None, triggers=None, cache=None):
         if skill_nrs is None: skill_nrs = helpers.get_existing_classifiers(dir)
+        self.dir = dir
         self.classifiers = {nr: models.load_classifier(nr, dir) for nr in skill_nrs}
+        self.versions = {nr: weights_hash(f'../models/{dir}/{nr}.pth') for nr in skill_nrs}
+        self.triggers = models.TriggerIndex.load(triggers) if isinstance(triggers, str) else triggers
+        if self.triggers is not None: self.triggers.check(dir)
+        self.cache = cache if isinstance(cache, DetectionCache) else DetectionCache(cache)
+        self.cache.purge(dir, self.versions)
 
+    @tracing.traced("detector_scoring")
     def score_texts(self, sentences, constraints=None):
         if constraints is None: constraints = self.classifiers.keys()
         return {nr: models.probe_model(self.classifiers[nr], sentences) for nr in constraints}
 
     def constraint_satisfaction(self, text, constraints):
-        if text=="": return [0.0 for _ in constraints]
-        sentences = nltk.sent_tokenize(text)
-        
+        return self.satisfaction_many([text], [constraints])[0]
+
+    @tracing.traced("detector_scoring")
+    def satisfaction_many(self, texts, constraints_list, batch_size=128):
+        """
+        Detects the constraints of many texts at once, each distinct sentence is scored once for the union of the constructs requested for it
+        """
+        sentences_list = [nltk.sent_tokenize(text) if text!="" else [] for text in texts]
+        needed = {}
+        for sentences, constraints in zip(sentences_list, constraints_list):
+            for sentence in sentences:
+                needed.setdefault(sentence, set()).update(constraints)
+        unique = list(needed)
+        constructs = [needed[sentence] for sentence in unique]
+        if self.triggers is not None:
+            for i in range(0, len(unique), batch_size):
+                input_ids = models.bert_tokenizer(unique[i:i+batch_size], return_tensors='pt', max_length=64, padding='max_length', truncation=True)['input_ids']
+                for nr in set().union(*constructs[i:i+batch_size]):
+                    for j, keep in enumerate(self.triggers.mask(nr, input_ids).tolist()):
+                        if not keep: constructs[i+j].discard(nr)
+
+        scores = {sentence: {} for sentence in unique}
+        for sentence, nrs in zip(unique, constructs):
+            for nr in list(nrs):
+                value = self.cache.get((normalize_sentence(sentence), self.dir, str(nr), self.versions[nr]))
+                if value is not None:
+                    scores[sentence][nr] = tuple(value)
+                    nrs.discard(nr)
+        misses = [(sentence, nrs) for sentence, nrs in zip(unique, constructs) if nrs]
+        new_scores = models.score_pairs(self.classifiers, [sentence for sentence, _ in misses], [nrs for _, nrs in misses], batch_size)
+        for (sentence, _), results in zip(misses, new_scores):
+            scores[sentence].update(results)
+        self.cache.put_many([((normalize_sentence(sentence), self.dir, str(nr), self.versions[nr]), value) for (sentence, _), results in zip(misses, new_scores) for nr, value in results.items()])
+
         hits = []
-        for nr in constraints:
-            outputs = models.probe_model(self.classifiers[nr], sentences)
-            hits.append((outputs[0]>0.5).any().item())
+        for text, sentences, constraints in zip(texts, sentences_list, constraints_list):
+            if text=="": hits.append([0.0 for _ in constraints])
+            else: hits.append([any(scores[sentence].get(nr, (0., None))[0]>0.5 for sentence in sentences) for nr in constraints])
         return hits
 
-detector = GrammarDetection()
+detector = GrammarDetection(triggers=os.getenv("TRIGGER_INDEX") or None, cache=os.getenv("DETECTION_CACHE") or None)
 
 gpt_metrics = {
     "Appropriateness": "Given the Context, evaluate from 1-5 the Response in terms of Appropriateness. Provide a single score and nothing else.",
@@ -63,58 +182,253 @@ def completion_to_score(message):
 def join_context(context):
     return os.linesep.join([("A" if (i%2==0) else "B") + ": " + utt for i, utt in enumerate(context)])
     
-def get_single_response_metric(metric, context, response):
+judge_kwargs = {"model": "gpt-4o", "temperature": 0.0, "max_tokens": 20}
+
+class JudgeCache():
+    """
+    Content-addressed store of judge completions in SQLite with write-ahead logging so that several evaluation processes can share it, only deterministic calls at temperature 0 are cached
+    """
+    schema_version = 2
+
+    def __init__(self, path=None):
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, timeout=30)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.migrate()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def migrate(self):
+        """
+        Stores of the first schema keyed scores by other request fields, their entries cannot be reused and are dropped
+        """
+        with self.db:
+            if self.db.execute("PRAGMA user_version").fetchone()[0] < self.schema_version:
+                self.db.execute("DROP TABLE IF EXISTS judgements")
+                self.db.execute(f"PRAGMA user_version={self.schema_version}")
+            self.db.execute("CREATE TABLE IF NOT EXISTS judgements (key TEXT PRIMARY KEY, completion TEXT)")
+
+    def key(self, messages, **kwargs):
+        return hashlib.sha256(json.dumps({"messages": messages, **kwargs}, sort_keys=True).encode()).hexdigest()
+
+    def get(self, messages, **kwargs):
+        if self.db is None or kwargs.get("temperature") != 0: return None
+        row = self.db.execute("SELECT completion FROM judgements WHERE key=?", (self.key(messages, **kwargs),)).fetchone()
+        self.stats["hits" if row else "misses"] += 1
+        return row[0] if row else None
+
+    def put_many(self, items):
+        """
+        Stores (messages, request kwargs, completion) tuples, callers only pass completions that parsed
+        """
+        if self.db is None: return
+        rows = [(self.key(messages, **kwargs), completion) for messages, kwargs, completion in items if kwargs.get("temperature") == 0]
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO judgements VALUES (?, ?)", rows)
+
+    def hit_rate(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.
+
+    def summary(self):
+        return f"Judge cache: {self.hit_rate():.1%} hit rate ({self.stats['hits']} hits, {self.stats['misses']} misses)"
+
+judge_cache = JudgeCache(os.getenv("JUDGE_CACHE") or None)
+judge_client = api.AsyncChatClient(max_concurrency=int(os.getenv("JUDGE_CONCURRENCY") or 16), rpm=int(os.getenv("JUDGE_RPM") or 500), tpm=int(os.getenv("JUDGE_TPM") or 30000))
+
+def judge_messages(metric, context, response):
     if isinstance(context, list): context = join_context(context)
     prompt = gpt_metrics[metric]
     text_prompt = f"Context:\n{context}\n" if not metric == "Grammatical Correctness" else ""
     text_prompt += f"Response:\n{response}"
+    return [{"role": "system", "content": prompt},
+            {"role": "user", "content": text_prompt}]
+
+@tracing.traced("judge")
+def get_single_response_metric(metric, context, response):
+    messages = judge_messages(metric, context, response)
+    cached = judge_cache.get(messages, **judge_kwargs)
+    if cached is not None: return completion_to_score(cached)
     gpt_score = -1
     score_backoff = 0
     while gpt_score == -1 and score_backoff < 2:
-        responses = api.get_openai_chat_completion(
-            model="gpt-4o",
-            temperature=0.0,
-            max_tokens=20,
-            messages=[
-                {"role": "system", "content": prompt},
-                {"role": "user", "content": text_prompt},
-            ],
-        )
+        responses = api.get_openai_chat_completion(messages=messages, **judge_kwargs)
         gpt_score = completion_to_score(responses[0])
         score_backoff += 1
+    if gpt_score != -1: judge_cache.put_many([(messages, judge_kwargs, responses[0])])
     if gpt_score != -1:
         return gpt_score
     return 3 # default
 
-def get_response_quality(context, response):
-    return {metric: get_single_response_metric(metric, context, response) for metric in tqdm(gpt_metrics.keys(), desc="Responses", leave=False)}
+@tracing.traced("judge")
+def get_metrics_concurrently(items):
+    """
+    Judges (metric, context, response) triples with concurrent requests, unparsable scores are requested once more and default to 3 like in get_single_response_metric
+    """
+    messages = [judge_messages(*item) for item in items]
+    scores = [judge_cache.get(message, **judge_kwargs) for message in messages]
+    scores = [completion_to_score(completion) if completion is not None else -1 for completion in scores]
+    pending = [i for i, score in enumerate(scores) if score == -1]
+    for _ in range(2):
+        if not pending: break
+        completions = judge_client.run([{"messages": messages[i], **judge_kwargs} for i in pending])
+        for i, completion in zip(pending, completions):
+            scores[i] = completion_to_score(completion[0])
+        judge_cache.put_many([(messages[i], judge_kwargs, completion[0]) for i, completion in zip(pending, completions) if scores[i] != -1])
+        pending = [i for i in pending if scores[i] == -1]
+    return [score if score != -1 else 3 for score in scores]
+
+combined_prompt = "Given the Context, evaluate from 1-5 the Response in terms of Appropriateness, Relevance and Content Richness, and evaluate from 1-5 the Response in terms of Grammatical Correctness regardless of the Context. Answer with a JSON object with the keys " + ", ".join(f'"{metric}"' for metric in gpt_metrics.keys()) + " and a single score for each and nothing else."
+combined_kwargs = {**judge_kwargs, "max_tokens": 100, "response_format": {"type": "json_object"}}
+combined_stats = {"calls": 0, "fallbacks": 0}
+
+def parse_combined_scores(completion):
+    """
+    Returns the valid scores of a combined judgement, metrics that are missing or out of range are left out
+    """
+    match = re.search(r"\{.*\}", completion, re.DOTALL)
+    try:
+        parsed = json.loads(match.group(0)) if match else {}
+    except json.JSONDecodeError:
+        parsed = {}
+    if not isinstance(parsed, dict): return {}
+    scores = {}
+    for metric in gpt_metrics.keys():
+        try:
+            score = float(parsed.get(metric))
+        except (TypeError, ValueError):
+            continue
+        if 1 <= score <= 5: scores[metric] = score
+    return scores
+
+@tracing.traced("judge")
+def get_response_quality_combined(contexts, responses):
+    """
+    Judges all metrics of a response in one JSON completion, metrics that fail to parse are judged with individual calls
+    """
+    messages = [[{"role": "system", "content": combined_prompt},
+                 {"role": "user", "content": f"Context:\n{join_context(context) if isinstance(context, list) else context}\nResponse:\n{response}"}] for context, response in zip(contexts, responses)]
+    completions = [judge_cache.get(message, **combined_kwargs) for message in messages]
+    pending = [i for i, completion in enumerate(completions) if completion is None]
+    for i, completion in zip(pending, judge_client.run([{"messages": messages[i], **combined_kwargs} for i in pending])):
+        completions[i] = completion[0]
+    qualities = [parse_combined_scores(completion) for completion in completions]
+    judge_cache.put_many([(messages[i], combined_kwargs, completions[i]) for i in pending if qualities[i]])
+
+    fallbacks = [(i, metric) for i, quality in enumerate(qualities) for metric in gpt_metrics.keys() if metric not in quality]
+    for (i, metric), score in zip(fallbacks, get_metrics_concurrently([(metric, contexts[i], responses[i]) for i, metric in fallbacks])):
+        qualities[i][metric] = score
+    combined_stats["calls"] += len(pending)
+    combined_stats["fallbacks"] += len(fallbacks)
+    return [{metric: quality[metric] for metric in gpt_metrics.keys()} for quality in qualities]
+
+class LocalJudge():
+    """
+    Judges response quality with a local causal LM as the expected score under the next-token distribution over "1" to "5", the prompts of all metrics share the context and response as prefix
+    """
+    def __init__(self, model_name="meta-llama/Meta-Llama-3-8B-Instruct", model=None, tokenizer=None, batch_size=8):
+        if model is None: model, tokenizer = models.load_generator(model_name)
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.score_ids = torch.tensor([tokenizer.encode(str(score), add_special_tokens=False)[-1] for score in range(1, 6)], device=models.device)
+
+    def prompt_ids(self, context, response):
+        """
+        Token ids of the shared prefix and of the metric-specific suffixes
+        """
+        if isinstance(context, list): context = join_context(context)
+        ids = [self.tokenizer.apply_chat_template([{"role": "user", "content": f"Context:\n{context}\nResponse:\n{response}\n\n{prompt}"}], add_generation_prompt=True) for prompt in gpt_metrics.values()]
+        prefix_len = models.common_prefix_length(ids)
+        return ids[0][:prefix_len], [metric_ids[prefix_len:] for metric_ids in ids]
+
+    def forward(self, prompts):
+        n_metrics = len(gpt_metrics)
+        prefixes = [prefix for prefix, _ in prompts]
+        suffixes = [suffix for _, suffixes in prompts for suffix in suffixes]
+        prefix_len, suffix_len = max(len(prefix) for prefix in prefixes), max(len(suffix) for suffix in suffixes)
+        pad = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+        # left-padded prefixes are encoded once per response and their cache is repeated for every metric
+        prefix_mask = torch.tensor([[0] * (prefix_len - len(prefix)) + [1] * len(prefix) for prefix in prefixes], device=models.device)
+        prefix_ids = torch.tensor([[pad] * (prefix_len - len(prefix)) + prefix for prefix in prefixes], device=models.device)
+        prefix_positions = (prefix_mask.cumsum(dim=1) - 1).clamp(min=0)
+        with torch.no_grad():
+            outputs = self.model(prefix_ids, attention_mask=prefix_mask, position_ids=prefix_positions, use_cache=True)
+        past = outputs.past_key_values.to_legacy_cache() if isinstance(outputs.past_key_values, DynamicCache) else outputs.past_key_values
+        past = DynamicCache.from_legacy_cache(tuple((key.repeat_interleave(n_metrics, dim=0), value.repeat_interleave(n_metrics, dim=0)) for key, value in past))
+        # right-padded suffixes continue at the position after their prefix
+        suffix_mask = torch.tensor([[1] * len(suffix) + [0] * (suffix_len - len(suffix)) for suffix in suffixes], device=models.device)
+        suffix_ids = torch.tensor([suffix + [pad] * (suffix_len - len(suffix)) for suffix in suffixes], device=models.device)
+        suffix_positions = prefix_mask.sum(dim=1).repeat_interleave(n_metrics).unsqueeze(1) + torch.arange(suffix_len, device=models.device)
+        with torch.no_grad():
+            logits = self.model(suffix_ids, attention_mask=torch.cat([prefix_mask.repeat_interleave(n_metrics, dim=0), suffix_mask], dim=1), position_ids=suffix_positions, past_key_values=past).logits
+        last = logits[torch.arange(len(suffixes)), suffix_mask.sum(dim=1) - 1]
+        probs = F.softmax(last[:, self.score_ids].float(), dim=-1)
+        return (probs * torch.arange(1, 6, device=models.device)).sum(dim=-1).view(-1, n_metrics).cpu().tolist()
+
+    @tracing.traced("judge")
+    def score(self, contexts, responses):
+        qualities = []
+        for i in tqdm(range(0, len(responses), self.batch_size), desc="Local judge", leave=False):
+            prompts = [self.prompt_ids(context, response) for context, response in zip(contexts[i:i+self.batch_size], responses[i:i+self.batch_size])]
+            qualities += [dict(zip(gpt_metrics.keys(), scores)) for scores in self.forward(prompts)]
+        return qualities
+
+def get_response_quality(context, response, combined=False, judge=None):
+    return get_response_quality_many([context], [response], combined, judge)[0]
+
+def get_response_quality_many(contexts, responses, combined=False, judge=None):
+    if judge is not None: return judge.score(contexts, responses)
+    if combined: return get_response_quality_combined(contexts, responses)
+    scores = iter(get_metrics_concurrently([(metric, context, response) for context, response in zip(contexts, responses) for metric in gpt_metrics.keys()]))
+    return [{metric: next(scores) for metric in gpt_metrics.keys()} for _ in responses]
+
+def constraint_hits(responses, positive_skills_list, negative_skills_list=None):
+    """
+    Detects positive and negative constraints of all responses in one pass, constructs in both lists are only scored once
+    """
+    if negative_skills_list is None: negative_skills_list = [[] for _ in responses]
+    union = [list(dict.fromkeys(list(positive) + list(negative))) for positive, negative in zip(positive_skills_list, negative_skills_list)]
+    hits = [dict(zip(skills, satisfaction)) for skills, satisfaction in zip(union, detector.satisfaction_many(responses, union))]
+    return [[hit[nr] for nr in positive] for hit, positive in zip(hits, positive_skills_list)], [[hit[nr] for nr in negative] for hit, negative in zip(hits, negative_skills_list)]
 
 def multiple_constraints(responses_list, skills_list):
-    return [[detector.constraint_satisfaction(response, skills) for response in responses] for responses, skills in zip(responses_list, skills_list)]
+    flat_responses = [response for responses in responses_list for response in responses]
+    flat_skills = [skills for responses, skills in zip(responses_list, skills_list) for _ in responses]
+    hits = iter(detector.satisfaction_many(flat_responses, flat_skills))
+    return [[next(hits) for _ in responses] for responses in responses_list]
 
 def calc_metrics(contexts, outputs, constraints, eval_quality=False):
-    scores = [np.mean(detector.constraint_satisfaction(output, constraint)) for output, constraint in zip(outputs, constraints)]
+    scores = [np.mean(hits) for hits in detector.satisfaction_many(outputs, constraints)]
     constraint_outputs = lambda comb: [outputs[idx] for idx, constraint in enumerate(constraints) if constraint==comb]
     distinct = [calculate_distinct_n(constraint_outputs(comb)) for comb in np.unique(constraints)]
     if eval_quality:
-        iter_metrics = tqdm(gpt_metrics.keys(), desc="Metrics", total=len(gpt_metrics))
-        iter_responses = lambda: tqdm(zip(contexts, outputs), desc="Responses", total=len(outputs))
-        quality = {metric: [get_single_response_metric(metric, context, output) for context, output in iter_responses()] for metric in iter_metrics}
+        qualities = get_response_quality_many(contexts, outputs)
+        quality = {metric: [q[metric] for q in qualities] for metric in gpt_metrics.keys()}
     return scores, distinct, (quality if eval_quality else {})
 
 """
 Input: one context and reponses to evaluate
 Output: dict with evaluations
 """
-def evaluate(context, response, positive_skills, negative_skills=None, evaluate_quality=True):
-    positive_satisfaction = detector.constraint_satisfaction(response, positive_skills)
-    negative_constraints = {"negative_constraints": detector.constraint_satisfaction(response, negative_skills)} if negative_skills else {}
-    qualities = get_response_quality(context, response) if evaluate_quality else {}
-    
-    return {"positive_constraints": positive_satisfaction,
-            **negative_constraints,
-            **qualities
-    }
+def evaluate(context, response, positive_skills, negative_skills=None, evaluate_quality=True, combined_judge=False, judge=None):
+    return evaluate_testset([context], [response], [positive_skills], [negative_skills] if negative_skills else None, evaluate_quality, combined_judge, judge)[0]
+
+"""
+Input: contexts and one response per context with their skills
+Output: list of dicts with evaluations, the constraints of all responses are detected in one encoder sweep
+"""
+def evaluate_testset(contexts, responses, positive_skills_list, negative_skills_list=None, evaluate_quality=True, combined_judge=False, judge=None):
+    positive_satisfaction, negative_satisfaction = constraint_hits(responses, positive_skills_list, negative_skills_list)
+    qualities = get_response_quality_many(contexts, responses, combined_judge, judge) if evaluate_quality else [{} for _ in responses]
+    results = []
+    for i in range(len(responses)):
+        negative_constraints = {"negative_constraints": negative_satisfaction[i]} if negative_skills_list and negative_skills_list[i] else {}
+        results.append({"positive_constraints": positive_satisfaction[i],
+                        **negative_constraints,
+                        **qualities[i]
+        })
+    return results
     
 """
 Input: lists of response sets to evaluate
@@ -122,10 +436,13 @@ Output: dict with list of evaluations
 """
 def evaluate_responses(contexts, responses_list, positive_skills_list, negative_skills_list=None):
     distinct_2 = [calculate_distinct_n(responses) for responses in responses_list]
-    positive_satisfaction = multiple_constraints(responses_list, positive_skills_list)
-    negative_constraints = {"negative_constraints": 
-                            multiple_constraints(responses_list, negative_skills_list)} if negative_skills_list else {}
-    qualities = [get_response_quality(context, responses) for context, responses in tqdm(zip(contexts, responses_list), total=len(contexts), desc="Contexts")]
+    flat_responses = [response for responses in responses_list for response in responses]
+    repeat = lambda skills_list: [skills for responses, skills in zip(responses_list, skills_list) for _ in responses]
+    positive_hits, negative_hits = constraint_hits(flat_responses, repeat(positive_skills_list), repeat(negative_skills_list) if negative_skills_list else None)
+    regroup = lambda hits: [[next(hits) for _ in responses] for responses in responses_list]
+    positive_satisfaction = regroup(iter(positive_hits))
+    negative_constraints = {"negative_constraints": regroup(iter(negative_hits))} if negative_skills_list else {}
+    qualities = get_response_quality_many(contexts, responses_list)
     
     return {"Distinctiveness": distinct_2,
             "positive_constraints": positive_satisfaction,
@@ -5,6 +5,7 @@ import webbrowser
 import os
 import random
 import re
+import tracing
 
 # constants
 head = """
@@ -158,10 +159,12 @@ def get_messages(instruction, item, apply_chat_template, system_msg, next_speake
     item['messages'] += [{"role": "user", "content": f"{instruction}\nDialog:\n{format_context(item['context'])}\n"}]
     item['messages'] += [{"role": "assistant", "content": f"{item['response']}"}]
     if apply_chat_template:
-        item['prompt'] = apply_chat_template(item['messages'][:-1], tokenize=False, add_generation_prompt=True)
-        item['text'] = apply_chat_template(item['messages'], tokenize=False)
+        with tracing.span("templating"):
+            item['prompt'] = apply_chat_template(item['messages'][:-1], tokenize=False, add_generation_prompt=True)
+            item['text'] = apply_chat_template(item['messages'], tokenize=False)
     return item
 
+@tracing.traced("prompt_building")
 def get_generation_prompt(item, apply_chat_template=None, unconstrained=False, system_msg=False):
     if not unconstrained:
         rules = egp[egp['#'].isin(item['constraints'])]
@@ -195,12 +198,14 @@ def describe_subcat_level(subcat, level):
     preferred = egp_filtered[(egp_filtered['Level']==level)&(egp_filtered['SubCategory']==subcat)]
     return f"- {subcat} on CEFR level {level} ({'; '.join(preferred['guideword'])})"
     
+@tracing.traced("prompt_building")
 def get_prompt_task_2(item, apply_chat_template=None, unconstrained=False, system_msg=False):
     constraints = os.linesep.join([describe_subcat_level(subcat, level) for subcat, level in zip(item['categories'], item['levels'])])
     instruction = f"Given the dialog, write a possible next turn of A that preferably uses the following grammatical items in the response:"
     instruction += f"\n{constraints}" if not unconstrained else "" 
     return get_messages(instruction, item, apply_chat_template, system_msg)
 
+@tracing.traced("prompt_building")
 def get_prompt_task_3(item, apply_chat_template=None, system_msg=False):
     next_speaker = "A" if len(item['context']) % 2 == 0 else "B"
     instruction = f"Given the dialog, write a possible next turn of {next_speaker} that uses grammatical items on CEFR level {item['level']}."
@@ -215,13 +220,15 @@ description = {
     "A1": "Can interact in a simple way but communication is totally dependent on repetition at a slower rate, rephrasing and repair. Can ask and answer simple questions, initiate and respond to simple statements in areas of immediate need or on very familiar topics."
 }
 
+@tracing.traced("prompt_building")
 def get_CEFR_prompt(item, apply_chat_template=None):
     next_speaker = "A" if len(item['context']) % 2 == 0 else "B"
     instruction = f"Given the dialog, write a possible next turn of {next_speaker} that an English learner on CEFR level {item['CEFR']} could produce:"
     item = get_messages(instruction, item, apply_chat_template, False, next_speaker)
     item['messages'] = [{"role": "system", "content": f"Only output {next_speaker}'s response using language on CEFR level {item['CEFR']}. This level is described as: {description[item['CEFR']]}"}] + item['messages']
-    item['prompt'] = apply_chat_template(item['messages'][:-1], tokenize=False, add_generation_prompt=True)
-    item['text'] = apply_chat_template(item['messages'], tokenize=False)
+    with tracing.span("templating"):
+        item['prompt'] = apply_chat_template(item['messages'][:-1], tokenize=False, add_generation_prompt=True)
+        item['text'] = apply_chat_template(item['messages'], tokenize=False)
     return item
 
 def parse_response(response, format="A: "):
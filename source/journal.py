@@ -0,0 +1,87 @@
+# This module offers an append-only journal of per-row results that the task scripts compact into their JSON output files
+
+import os
+import json
+import time
+import pandas as pd
+
+def to_builtin(value):
+    return value.item() if hasattr(value, "item") else str(value)
+
+class ResultJournal():
+    """
+    Appends one JSON line per finished row next to an output file and syncs to disk in batches, compaction writes the rows into the output file.
+    Callers replay the journal into the loaded output with apply and pick pending rows from its columns, the journal only holds results that were not compacted yet.
+    """
+    def __init__(self, output_file, fsync_every=16, fsync_interval=10.):
+        self.output_file = output_file
+        self.path = output_file.replace(".json", "_journal.jsonl")
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.file = None
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def entries(self):
+        if not os.path.exists(self.path): return []
+        entries = []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError: # torn line after a crash
+                    continue
+        return entries
+
+    def completed(self):
+        """
+        Ids of the rows with results in the journal
+        """
+        return set(entry["id"] for entry in self.entries())
+
+    def ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def append(self, row_id, values):
+        if self.file is None:
+            self.file = open(self.path, 'a')
+            if self.file.tell() > 0 and not self.ends_with_newline(): self.file.write("\n") # start after a torn line
+        self.file.write(json.dumps({"id": row_id, "values": values}, default=to_builtin) + "\n")
+        self.file.flush()
+        self.unsynced += 1
+        if self.unsynced >= self.fsync_every or time.time() - self.last_sync >= self.fsync_interval: self.sync()
+
+    def sync(self):
+        if self.file is None or self.unsynced == 0: return
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def close(self):
+        self.sync()
+        if self.file is not None: self.file.close()
+        self.file = None
+
+    def apply(self, testset):
+        """
+        Writes the journaled values into the data frame, later entries of a row win
+        """
+        for entry in self.entries():
+            for key, value in entry["values"].items():
+                if key not in testset.columns: testset[key] = [None] * len(testset)
+                testset.at[entry["id"], key] = value
+        return testset
+
+    def compact(self, testset=None):
+        """
+        Writes the output file with all journaled rows and truncates the journal, whose rows the output file now holds
+        """
+        self.close()
+        if testset is None: testset = pd.read_json(self.output_file)
+        self.apply(testset)
+        testset.to_json(f"{self.output_file}.tmp")
+        os.replace(f"{self.output_file}.tmp", self.output_file)
+        if os.path.exists(self.path): os.remove(self.path)
+        return testset
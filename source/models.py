@@ -14,14 +14,21 @@ import math
 import re
 from tqdm import tqdm
 import copy
+import json
+import hashlib
+import sqlite3
 import time
+from collections import OrderedDict
+from functools import lru_cache
+from contextlib import contextmanager
 import torch
 import numpy as np
 from torch.utils.data import TensorDataset, DataLoader
 from torch.nn import DataParallel
 import torch.nn.functional as F
-from transformers import BertTokenizer, BertModel, AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, LogitsProcessor, EpsilonLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+from transformers import BertTokenizer, BertModel, AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, LogitsProcessor, EpsilonLogitsWarper, TopKLogitsWarper, TopPLogitsWarper, DynamicCache
 from torchmetrics import MetricCollection, classification
+import tracing
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
@@ -229,6 +236,92 @@ def score_corpus(model, dataloader, max_positive=10, max_batches=10, threshold=0
             if np.sum(np.array(all_values)>threshold) > max_positive: break
     return all_values, all_max_tokens, batches
 
+class TriggerIndex():
+    """
+    BERT token ids on which each grammar detector fires, sentences without any of them are skipped for that construct. Constructs without an index or with hits anchored on special tokens are never skipped.
+    """
+    def __init__(self, triggers=None, dir=None):
+        self.triggers = triggers if triggers else {} # construct number -> set of token ids or None for unfilterable
+        self.dir = dir # detectors the triggers were collected from
+        self.skipped = {}
+        self.checked = {}
+
+    def add(self, nr, token_ids):
+        if nr in self.triggers and self.triggers[nr] is None: return
+        if any(token_id in bert_tokenizer.all_special_ids for token_id in token_ids):
+            self.triggers[nr] = None
+        else:
+            self.triggers[nr] = self.triggers.get(nr, set()) | set(token_ids)
+
+    def contains(self, nr, input_ids):
+        """
+        Which of the encoded sentences contain a trigger of the construct
+        """
+        if self.triggers.get(nr) is None: return torch.ones(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        return torch.isin(input_ids, torch.tensor(sorted(self.triggers[nr]), device=input_ids.device)).any(dim=1)
+
+    def mask(self, nr, input_ids):
+        """
+        Like contains, counting the sentences that are checked and skipped at runtime
+        """
+        if self.triggers.get(nr) is None: return self.contains(nr, input_ids)
+        mask = self.contains(nr, input_ids)
+        self.checked[nr] = self.checked.get(nr, 0) + len(mask)
+        self.skipped[nr] = self.skipped.get(nr, 0) + (~mask).sum().item()
+        return mask
+
+    def fingerprint(self, nrs):
+        """
+        Hash of the triggers of the given constructs
+        """
+        return hashlib.sha1(json.dumps({str(nr): sorted(self.triggers[nr]) if self.triggers.get(nr) is not None else None for nr in nrs}, sort_keys=True).encode()).hexdigest()
+
+    def check(self, dir):
+        """
+        Triggers only hold for the detectors they were collected from
+        """
+        if self.dir is not None and self.dir != dir:
+            raise ValueError(f"Trigger index was built for the detectors in {self.dir}, not {dir}")
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({"dir": self.dir, "triggers": {str(nr): sorted(ids) if ids is not None else None for nr, ids in self.triggers.items()}}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            saved = json.load(f)
+        if "triggers" not in saved: saved = {"dir": None, "triggers": saved} # indices saved without their detector directory
+        return cls({int(nr): set(ids) if ids is not None else None for nr, ids in saved["triggers"].items()}, saved["dir"])
+
+def build_trigger_index(classifiers, examples, dataloader=None, threshold=0.5, max_batches=100, dir=None):
+    """
+    Collects the argmax tokens of positive detections on the EGP examples of each construct and optionally a pre-encoded corpus
+    """
+    index = TriggerIndex(dir=dir)
+    for nr, classifier in classifiers.items():
+        encoded_input = bert_tokenizer(examples[nr], return_tensors='pt', max_length=64, padding='max_length', truncation=True).to(device)
+        with torch.no_grad():
+            values, indices = classifier(encoded_input['input_ids'], encoded_input['attention_mask'])
+        hits = (values > threshold).nonzero().flatten().tolist()
+        index.add(nr, [encoded_input['input_ids'][j, indices[j]].item() for j in hits])
+        if dataloader is not None:
+            values, indices, _ = score_corpus(classifier, dataloader, max_positive=1e10, max_batches=max_batches, threshold=threshold, progress=False)
+            input_ids = dataloader.dataset.tensors[0]
+            index.add(nr, [input_ids[j, idx].item() for j, (value, idx) in enumerate(zip(values, indices)) if value > threshold])
+    return index
+
+def trigger_recall(index, sentences, nrs):
+    """
+    Fraction of correct detections per construct that the trigger index keeps
+    """
+    recall = {}
+    for nr in set(nrs):
+        subset = [sentence for sentence, other in zip(sentences, nrs) if other == nr]
+        input_ids = bert_tokenizer(subset, return_tensors='pt', max_length=64, padding='max_length', truncation=True)['input_ids']
+        recall[nr] = index.contains(nr, input_ids).float().mean().item()
+    return recall
+
 def save_classifier(classifier, nr, dir):
     """
     Save a grammar classifier to the specified subdirectory in the models directory
@@ -264,19 +357,155 @@ def load_generator(model_name= "mistralai/Mistral-7B-Instruct-v0.2", quantized=F
         tokenizer.pad_token = tokenizer.eos_token
     return model, tokenizer
 
-def generate(model, tokenizer, prompts, eos_token_id=None, max_new_tokens=128, batch_size=32, verbose=False, skip_special_tokens=True, do_sample=False, repetition_penalty=1.0, length_penalty=1.0, num_beams=1):
+def common_prefix_length(sequences):
+    """
+    Length of the longest token prefix that all given sequences share
+    """
+    length = 0
+    for tokens in zip(*sequences):
+        if any(token != tokens[0] for token in tokens[1:]): break
+        length += 1
+    return length
+
+class PrefixCache():
+    """
+    LRU store of key/value states for token prefixes that prompts share, e.g. the chat template header, system message and instruction
+    """
+    def __init__(self, model, max_entries=8, max_tokens=8192, min_prefix_len=16):
+        self.model = model
+        self.max_entries = max_entries
+        self.max_tokens = max_tokens
+        self.min_prefix_len = min_prefix_len
+        self.entries = OrderedDict()
+        self.last_ids = None
+        self.hits = 0
+        self.misses = 0
+
+    def compute(self, prefix):
+        with torch.no_grad():
+            outputs = self.model(torch.tensor([prefix], device=device), use_cache=True)
+        past = outputs.past_key_values
+        return past.to_legacy_cache() if isinstance(past, DynamicCache) else past
+
+    def evict(self):
+        while len(self.entries) > self.max_entries or sum(len(key) for key in self.entries) > self.max_tokens:
+            self.entries.popitem(last=False)
+
+    def match(self, ids_list):
+        """
+        Finds or computes the key/value states of the longest prefix shared by the batch (or by the previous call for single prompts) and forks them for every sequence
+        """
+        limit = min(len(ids) for ids in ids_list) - 1 # at least one token has to be fed to the model
+        best = max((key for key in self.entries if len(key) <= limit and all(tuple(ids[:len(key)]) == key for ids in ids_list)), key=len, default=())
+        reference = ids_list if len(ids_list) > 1 else ids_list + ([self.last_ids] if self.last_ids else [])
+        length = min(common_prefix_length(reference), limit) if len(reference) > 1 else 0
+        self.last_ids = list(ids_list[0])
+        if length >= self.min_prefix_len and length > len(best):
+            best = tuple(ids_list[0][:length])
+            self.entries[best] = self.compute(list(best))
+            self.misses += 1
+            self.evict()
+        elif best:
+            self.hits += 1
+        if not best or best not in self.entries: return 0, None
+        self.entries.move_to_end(best)
+        n = len(ids_list)
+        past = tuple((key.expand(n, -1, -1, -1), value.expand(n, -1, -1, -1)) for key, value in self.entries[best])
+        return len(best), DynamicCache.from_legacy_cache(past)
+
+def pad_after_prefix(ids_list, prefix_len, pad_token_id):
+    """
+    Pads the continuations between the shared prefix and their last token so that all sequences end at the same position
+    """
+    length = max(len(ids) for ids in ids_list)
+    input_ids = [ids[:prefix_len] + [pad_token_id] * (length - len(ids)) + ids[prefix_len:] for ids in ids_list]
+    attention_mask = [[1] * prefix_len + [0] * (length - len(ids)) + [1] * (len(ids) - prefix_len) for ids in ids_list]
+    return {"input_ids": torch.tensor(input_ids, device=device), "attention_mask": torch.tensor(attention_mask, device=device)}
+
+def model_fingerprint(model):
     """
-    This generates tokens and returns the decoded and extracted response to the dialog generation task
+    Name of the base model plus a fingerprint of its LoRA adapter weights, which change while fine-tuning
+    """
+    adapters = [param for name, param in model.named_parameters() if "lora_" in name]
+    if not adapters: return model.config._name_or_path
+    with torch.no_grad():
+        moments = torch.stack([torch.stack([param.float().sum(), param.float().pow(2).sum()]).to(device) for param in adapters]).cpu()
+    return f"{model.config._name_or_path}:{hashlib.sha1(moments.numpy().tobytes()).hexdigest()}"
+
+def module_fingerprint(module):
+    """
+    Hash of the trainable weights of a grammar detector or probe
+    """
+    digest = hashlib.sha1()
+    for name, param in module.named_parameters():
+        if param.requires_grad: digest.update(name.encode() + param.detach().float().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+class GenerationCache():
+    """
+    Persistent memo of deterministic generations in SQLite, keyed by model and adapter fingerprint, rendered prompt, generation kwargs and logits processor configuration
+    """
+    def __init__(self, path=None):
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, timeout=30)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS generations (key TEXT PRIMARY KEY, result TEXT)")
+        self.stats = {"hits": 0, "misses": 0}
+
+    def key(self, model_key, prompt, **config):
+        return hashlib.sha256(json.dumps({"model": model_key, "prompt": prompt, **config}, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, key):
+        row = self.db.execute("SELECT result FROM generations WHERE key=?", (key,)).fetchone()
+        self.stats["hits" if row else "misses"] += 1
+        return json.loads(row[0]) if row else None
+
+    def put_many(self, items):
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO generations VALUES (?, ?)", [(key, json.dumps(result)) for key, result in items])
+
+    def hit_rate(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.
+
+    def summary(self):
+        return f"Generation cache: {self.hit_rate():.1%} hit rate ({self.stats['hits']} hits, {self.stats['misses']} misses)"
+
+generation_cache = GenerationCache(os.getenv("GENERATION_CACHE") or None)
+
+def generate(model, tokenizer, prompts, eos_token_id=None, max_new_tokens=128, batch_size=32, verbose=False, skip_special_tokens=True, do_sample=False, repetition_penalty=1.0, length_penalty=1.0, num_beams=1, prefix_cache=None, memo=None, truncate=True):
+    """
+    This generates tokens and returns the decoded and extracted response to the dialog generation task, greedy generations are looked up in the generation cache first.
+    Prompts are cut to 512 tokens unless truncate is False, then batches are padded to their longest prompt.
     """
     tokenizer.padding_side = "left"
     if eos_token_id == None: eos_token_id = [tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<|eot_id|>")]
     model.eval()
+    memo = generation_cache if memo is None else memo
+    keys, cached = [], {}
+    if memo.db is not None and not do_sample:
+        model_key = model_fingerprint(model)
+        keys = [memo.key(model_key, prompt, function="generate", eos_token_id=eos_token_id, max_new_tokens=max_new_tokens, skip_special_tokens=skip_special_tokens,
+                         repetition_penalty=repetition_penalty, length_penalty=length_penalty, num_beams=num_beams, truncate=truncate) for prompt in prompts]
+        for i, key in enumerate(keys):
+            result = memo.get(key)
+            if result is not None: cached[i] = result
+    pending = [prompt for i, prompt in enumerate(prompts) if i not in cached]
     outputs = []
-    for i in tqdm(range(0, len(prompts), batch_size), total=math.ceil(len(prompts)/batch_size), desc="Generate"):
-        batch = prompts[i:i + batch_size]
-        model_input = tokenizer(batch, return_tensors="pt", padding='max_length', truncation=True, max_length=512).to(device)
+    for i in tqdm(range(0, len(pending), batch_size), total=math.ceil(len(pending)/batch_size), desc="Generate"):
+        batch = pending[i:i + batch_size]
+        kwargs = {}
+        if prefix_cache is not None and num_beams == 1: # cache forks are not expanded to beams
+            with tracing.span("tokenization"):
+                ids_list = tokenizer(batch, truncation=truncate, max_length=512 if truncate else None)['input_ids']
+            prefix_len, kwargs['past_key_values'] = prefix_cache.match(ids_list)
+            model_input = pad_after_prefix(ids_list, prefix_len, tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id)
+        else:
+            with tracing.span("tokenization"):
+                model_input = tokenizer(batch, return_tensors="pt", padding='max_length' if truncate else 'longest', truncation=truncate, max_length=512 if truncate else None).to(device)
         if verbose: print(model_input)
-        with torch.no_grad():
+        with torch.no_grad(), tracing.span("generation"):
             token_ids = model.generate(**model_input,
                                        max_new_tokens=max_new_tokens,
                                        pad_token_id=tokenizer.eos_token_id,
@@ -286,17 +515,94 @@ def generate(model, tokenizer, prompts, eos_token_id=None, max_new_tokens=128, b
                                        top_p=0.9 if do_sample else None,
                                        repetition_penalty=repetition_penalty,
                                        length_penalty=length_penalty,
-                                       num_beams=num_beams)
+                                       num_beams=num_beams,
+                                       **kwargs)
         
         outputs += tokenizer.batch_decode(token_ids[:,model_input['input_ids'].shape[1]:],
                                           skip_special_tokens=skip_special_tokens,
                                           device="cpu")
         if verbose: print(outputs[-batch_size:])
     tokenizer.padding_side = "right"
+    if keys:
+        memo.put_many(zip([key for i, key in enumerate(keys) if i not in cached], outputs))
+        generated = iter(outputs)
+        outputs = [cached[i] if i in cached else next(generated) for i in range(len(keys))]
     responses = [re.search(r'(.*)(\nB:)?', output.strip()).group(1) for output in outputs]
     responses=outputs
     return responses[0] if len(responses)==1 else responses
 
+@tracing.traced("detector_scoring")
+def score_all(classifiers, sentences, batch_size=128):
+    """
+    Scores sentences with a bank of grammar detectors sharing one encoder pass per batch, returns a constructs x sentences tensor
+    """
+    all_scores = []
+    for i in range(0, len(sentences), batch_size):
+        tokenized_inputs = bert_tokenizer(sentences[i:i+batch_size], return_tensors='pt', max_length=64, padding='max_length', truncation=True)
+        tokenized_inputs = {key: value.to(device) for key, value in tokenized_inputs.items()}
+        with torch.no_grad():
+            x = torch.cat(bert_encoder(**tokenized_inputs).hidden_states, dim=-1)
+            all_scores.append(torch.vstack([clf.forward_bert(x, tokenized_inputs['attention_mask'])[0] for clf in classifiers.values()]))
+    return torch.cat(all_scores, dim=1).cpu() if all_scores else torch.zeros(len(classifiers), 0)
+
+@tracing.traced("detector_scoring")
+def score_pairs(classifiers, sentences, constructs, batch_size=128):
+    """
+    Scores each sentence only with the detectors listed for it, every batch of sentences shares one encoder pass, returns one dict of construct scores and maximum scoring tokens per sentence
+    """
+    results = [{} for _ in sentences]
+    for i in range(0, len(sentences), batch_size):
+        batch_constructs = constructs[i:i+batch_size]
+        needed = set().union(*batch_constructs)
+        if not needed: continue
+        tokenized_inputs = bert_tokenizer(sentences[i:i+batch_size], return_tensors='pt', max_length=64, padding='max_length', truncation=True)
+        tokenized_inputs = {key: value.to(device) for key, value in tokenized_inputs.items()}
+        with torch.no_grad():
+            x = torch.cat(bert_encoder(**tokenized_inputs).hidden_states, dim=-1)
+            for nr in needed:
+                rows = [j for j, nrs in enumerate(batch_constructs) if nr in nrs]
+                index = torch.tensor(rows, device=device)
+                values, indices = classifiers[nr].forward_bert(x[index], tokenized_inputs['attention_mask'][index])
+                max_ids = tokenized_inputs['input_ids'][index].gather(1, indices.unsqueeze(1)).flatten().tolist()
+                for j, score, token in zip(rows, values.cpu().tolist(), bert_tokenizer.convert_ids_to_tokens(max_ids)): results[i+j][nr] = (score, token)
+    return results
+
+def best_of_n(model, tokenizer, prompt, classifiers, n=8, max_new_tokens=128, tie_break="likelihood", return_all=False):
+    """
+    Samples n responses in one generate call and returns the one satisfying most constraints at sentence level, ties are broken by mean token log-likelihood
+    """
+    with tracing.span("tokenization"):
+        model_input = tokenizer(prompt, return_tensors="pt").to(device)
+    input_len = model_input.input_ids.shape[1]
+    with torch.no_grad(), tracing.span("generation"):
+        outputs = model.generate(**model_input,
+                                 max_new_tokens=max_new_tokens,
+                                 pad_token_id=tokenizer.eos_token_id,
+                                 eos_token_id=[tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<|eot_id|>")],
+                                 do_sample=True,
+                                 temperature=1,
+                                 top_p=0.95,
+                                 top_k=300,
+                                 num_return_sequences=n,
+                                 return_dict_in_generate=True,
+                                 output_scores=True)
+    responses = tokenizer.batch_decode(outputs.sequences[:,input_len:], skip_special_tokens=True)
+    transition_scores = model.compute_transition_scores(outputs.sequences, outputs.scores, normalize_logits=True)
+    generated = outputs.sequences[:,input_len:] != tokenizer.eos_token_id
+    likelihood = (transition_scores.masked_fill(~generated, 0.).sum(dim=1) / generated.sum(dim=1).clamp(min=1)).cpu().tolist() # pads after EOS score -inf under the sampling warpers, multiplying them by 0 would give NaN
+
+    sentences = [sent_tokenize(response) or [""] for response in responses]
+    scores = score_all(classifiers, [sentence for response in sentences for sentence in response])
+    satisfaction, start = [], 0
+    for response in sentences:
+        hits = (scores[:, start:start+len(response)] > 0.5).any(dim=1) if len(classifiers) else torch.zeros(0)
+        satisfaction.append(hits.float().mean().item() if len(classifiers) else 0.)
+        start += len(response)
+    keys = [(sat, ll if tie_break == "likelihood" else 0.) for sat, ll in zip(satisfaction, likelihood)]
+    best = max(range(n), key=lambda j: keys[j])
+    if return_all: return responses[best], {"responses": responses, "satisfaction": satisfaction, "likelihood": likelihood}
+    return responses[best]
+
 def clean_tensors():
     """
     This helpers cleans tensors from memory
@@ -312,65 +618,549 @@ def clean_tensors():
     torch.cuda.empty_cache()
     
 
+word_boundary_masks = {}
+def get_word_boundary_mask(tokenizer):
+    """
+    Marks the vocabulary entries that begin a new word or are punctuation or special tokens, i.e. the tokens after which the previous word is complete
+    """
+    key = tokenizer.name_or_path
+    if key not in word_boundary_masks:
+        tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+        special = set(tokenizer.all_special_tokens)
+        word_boundary_masks[key] = torch.tensor([token is None or token in special or token[0] in "▁Ġ" or not any(c.isalnum() for c in token) for token in tokens], device=device)
+    return word_boundary_masks[key]
+
+@lru_cache(maxsize=65536)
+def get_wordpieces(word):
+    return tuple(bert_tokenizer.convert_tokens_to_ids(bert_tokenizer.tokenize(word)))
+
+class TokenBridge():
+    """
+    Converts generator tokens to BERT wordpieces without decoding candidate sequences to text. BERT splits text on whitespace before splitting punctuation and wordpieces, so the pieces of a sequence are the pieces of its completed words plus those of the word being generated.
+    """
+    def __init__(self, tokenizer):
+        special = set(tokenizer.all_special_ids)
+        tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+        self.texts = ["" if (i in special or token is None) else self.token_text(tokenizer, token) for i, token in enumerate(tokens)]
+
+    @staticmethod
+    def token_text(tokenizer, token):
+        if re.fullmatch(r"<0x[0-9A-F]{2}>", token): # sentencepiece byte fallback
+            byte = int(token[3:5], 16)
+            return chr(byte) if byte < 128 else ""
+        if "▁" in token: return token.replace("▁", " ")
+        return tokenizer.convert_tokens_to_string([token]).replace("\ufffd", "")
+
+    def advance(self, buffer, token_id):
+        """
+        Returns the (completed wordpieces, current word) buffer after appending one generator token
+        """
+        pieces, current = buffer
+        parts = re.split(r"(\s+)", current + self.texts[token_id])
+        for word in parts[:-1]:
+            if word and not word.isspace(): pieces = pieces + get_wordpieces(word)
+        return pieces, parts[-1]
+
+    def encode(self, buffers, entry, candidate_tokens, max_length=64):
+        """
+        Assembles the padded BERT inputs for all (row, candidate token) pairs like bert_tokenizer with padding='max_length' would
+        """
+        input_ids = torch.full((len(entry), max_length), bert_tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(entry), max_length), dtype=torch.long)
+        for j, (i, token_id) in enumerate(zip(entry.tolist(), candidate_tokens.tolist())):
+            pieces, current = self.advance(buffers[i], token_id)
+            ids = [bert_tokenizer.cls_token_id] + list((pieces + get_wordpieces(current))[:max_length-2]) + [bert_tokenizer.sep_token_id]
+            input_ids[j, :len(ids)] = torch.tensor(ids)
+            attention_mask[j, :len(ids)] = 1
+        return {"input_ids": input_ids.to(device), "token_type_ids": torch.zeros_like(input_ids).to(device), "attention_mask": attention_mask.to(device)}
+
+token_bridges = {}
+def get_token_bridge(tokenizer):
+    if tokenizer.name_or_path not in token_bridges:
+        token_bridges[tokenizer.name_or_path] = TokenBridge(tokenizer)
+    return token_bridges[tokenizer.name_or_path]
+
+def center_grammar_scores(grammar_scores, entry, n_rows):
+    """
+    Subtracts the mean over the candidates of the same row from the scores of each construct
+    """
+    counts = torch.bincount(entry, minlength=n_rows).clamp(min=1)
+    means = torch.zeros(grammar_scores.shape[0], n_rows, device=grammar_scores.device).index_add(1, entry, grammar_scores) / counts
+    return grammar_scores - means[:, entry]
+
+def fuse_grammar_logits(scores, entry, candidate_tokens, grammar_logits, alpha):
+    """
+    Log-softmax of the grammar logits within each row and alpha blending as one segment operation over all (row, candidate) pairs
+    """
+    grammar_logits = grammar_logits.float()
+    row_max = torch.full((scores.shape[0],), -float("inf"), device=scores.device).scatter_reduce(0, entry, grammar_logits, reduce="amax")
+    normalizer = torch.zeros(scores.shape[0], device=scores.device).index_add(0, entry, torch.exp(grammar_logits - row_max[entry]))
+    grammar_logits = grammar_logits - row_max[entry] - torch.log(normalizer)[entry]
+    scores[entry, candidate_tokens] = ((1-alpha)*scores[entry, candidate_tokens].float() + alpha * grammar_logits).to(scores.dtype)
+    return scores
+
+class DecodingMetrics():
+    """
+    Per-step measurements of constrained decoding grouped by test case, exportable as JSON or Chrome trace events
+    """
+    def __init__(self):
+        self.case = None
+        self.case_steps = 0
+        self.steps = []
+        self.events = []
+        self.origin = time.perf_counter()
+
+    def start_case(self, case):
+        self.case = case
+        self.case_steps = 0
+        if torch.cuda.is_available(): torch.cuda.reset_peak_memory_stats()
+
+    def add_step(self, **values):
+        self.steps.append({"case": self.case, "step": self.case_steps, "times": {}, **values})
+        self.case_steps += 1
+        return self.steps[-1]
+
+    @contextmanager
+    def span(self, name, step):
+        if torch.cuda.is_available(): torch.cuda.synchronize()
+        start = time.perf_counter()
+        yield
+        if torch.cuda.is_available(): torch.cuda.synchronize()
+        duration = time.perf_counter() - start
+        step["times"][name] = step["times"].get(name, 0.) + duration
+        step["peak_memory"] = torch.cuda.max_memory_allocated() if torch.cuda.is_available() else 0
+        self.events.append({"name": name, "ph": "X", "pid": 0, "tid": 0, "ts": (start - self.origin) * 1e6, "dur": duration * 1e6, "args": {"case": str(self.case), "step": step["step"]}})
+
+    def summary(self):
+        """
+        Aggregates the steps of each test case: step count, candidate and sequence length histograms, total time per phase and peak memory
+        """
+        cases = {}
+        for step in self.steps:
+            case = cases.setdefault(str(step["case"]), {"steps": 0, "candidates": {}, "unique_lengths": {}, "times": {}, "peak_memory": 0})
+            case["steps"] += 1
+            for key in ["candidates", "unique_lengths"]:
+                if key in step: case[key][step[key]] = case[key].get(step[key], 0) + 1
+            for name, duration in step["times"].items():
+                case["times"][name] = case["times"].get(name, 0.) + duration
+            case["peak_memory"] = max(case["peak_memory"], step.get("peak_memory", 0))
+        return cases
+
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump({"summary": self.summary(), "steps": self.steps}, f, default=str)
+
+    def to_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": self.events}, f)
+
 class GrammarLogitsProcessor(LogitsProcessor):
-    def __init__(self, tokenizer, classifiers, input_len, alpha, timing=False):
+    """
+    Blends the language model scores with the grammar scores of all candidate continuations, the schedule "every" scores each step, "word" only steps at word boundaries and "k" every score_every steps.
+    With stop_when_satisfied, constructs that a sequence already contains are dropped from its guidance and fully satisfied sequences fall back to plain decoding.
+    State is kept per generated prefix rather than per row because beam search reorders the rows between steps.
+    """
+    def __init__(self, tokenizer, classifiers, input_len, alpha, timing=False, schedule="every", score_every=1, reuse_scores=False, token_bridge=False, stop_when_satisfied=False, triggers=None, record=None, metrics=None):
         super().__init__()
         self.tokenizer = tokenizer
         self.classifiers = classifiers
         self.timing = timing
         self.input_len = input_len
         self.alpha = alpha
+        self.schedule = schedule
+        self.score_every = score_every
+        self.reuse_scores = reuse_scores
+        self.word_boundaries = get_word_boundary_mask(tokenizer) if schedule == "word" else None
+        self.bridge = get_token_bridge(tokenizer) if token_bridge else None
+        self.buffers = {} # per prefix: wordpiece buffer
+        self.last_logits = {} # per prefix: candidate tokens and grammar logits of its last scored step
+        self.stop_when_satisfied = stop_when_satisfied
+        self.triggers = triggers
+        self.record = record
+        self.metrics = metrics
+        self.step_metrics = None
+        self.satisfied = None # per row and construct
+        self.satisfied_by_prefix = {}
+        self.previous = {} # per prefix: candidate tokens and their grammar scores of the last scored step
+        self.steps = 0
+        self.stats = {"scored_steps": 0, "skipped_steps": 0, "per_sequence": {}}
 
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+    def scored_rows(self, rows, scores):
+        if self.schedule == "k":
+            return rows if (self.steps - 1) % self.score_every == 0 else rows[:0]
+        if self.schedule == "word": # score when the most likely continuation starts a new word
+            return rows[self.word_boundaries[scores[rows].argmax(dim=-1)]]
+        return rows
+
+    def fuse(self, scores, entry, candidate_tokens, grammar_logits):
+        return fuse_grammar_logits(scores, entry, candidate_tokens, grammar_logits, self.alpha)
+
+    def ancestor(self, states, prefix):
+        for k in range(len(prefix), -1, -1):
+            if prefix[:k] in states: return states[prefix[:k]]
+        return None
+
+    def reuse(self, rows, entry, candidate_tokens, scores, prefixes):
+        selected, logits = [], []
+        for i in rows.cpu().tolist():
+            last = self.ancestor(self.last_logits, prefixes[i])
+            if last is None: continue
+            tokens, values = last
+            mask = (entry==i).nonzero().flatten()
+            lookup = torch.full((scores.shape[1],), values.min().item(), device=scores.device) # unseen tokens fall back to the lowest grammar logit
+            lookup[tokens] = values
+            selected.append(mask)
+            logits.append(lookup[candidate_tokens[mask]])
+        if not selected: return scores
+        selected = torch.cat(selected)
+        return self.fuse(scores, entry[selected], candidate_tokens[selected], torch.cat(logits))
+
+    def update_satisfaction(self, prefixes):
+        """
+        The grammar scores of the chosen candidate are the scores of the current partial output, so satisfaction is tracked without extra detector passes
+        """
+        satisfied = []
+        for prefix in prefixes:
+            k = len(prefix)
+            while k > 0 and prefix[:k] not in self.satisfied_by_prefix: k -= 1 # longest ancestor with a known state
+            state = self.satisfied_by_prefix.get(prefix[:k], torch.zeros(len(self.classifiers), dtype=torch.bool, device=device))
+            for j in range(k, len(prefix)): # tokens appended since then, scored if their step ran the detectors
+                if prefix[:j] not in self.previous: continue
+                tokens, values = self.previous[prefix[:j]]
+                hit = (tokens == prefix[j]).nonzero()
+                if len(hit): state = state | (values[:, hit[0,0]] > 0.5)
+            satisfied.append(state)
+        self.satisfied = torch.stack(satisfied) if satisfied else torch.zeros(0, len(self.classifiers), dtype=torch.bool, device=device)
+        self.satisfied_by_prefix = dict(zip(prefixes, satisfied))
+        self.previous = {}
+
+    def count(self, rows, active):
+        self.stats["scored_steps"] += len(active)
+        self.stats["skipped_steps"] += len(rows) - len(active)
+        active = set(active.cpu().tolist())
+        for i in rows.cpu().tolist():
+            counters = self.stats["per_sequence"].setdefault(i, {"scored_steps": 0, "skipped_steps": 0, "satisfied": []})
+            counters["scored_steps" if i in active else "skipped_steps"] += 1
+            if self.satisfied is not None:
+                counters["satisfied"] = [nr for nr, done in zip(self.classifiers, self.satisfied[i].tolist()) if done]
+
+    def update_buffers(self, prefixes):
+        buffers = {}
+        for prefix in prefixes:
+            k = len(prefix)
+            while k > 0 and prefix[:k] not in self.buffers: k -= 1
+            buffer = self.buffers.get(prefix[:k], ((), ""))
+            for token_id in prefix[k:]:
+                buffer = self.bridge.advance(buffer, token_id)
+            buffers[prefix] = buffer
+        self.buffers = buffers
+
+    @contextmanager
+    def span(self, name):
         start = time.time()
+        if self.metrics is not None:
+            with self.metrics.span(name, self.step_metrics): yield
+        else:
+            yield
+        if self.timing: print(f"{name}: {time.time()-start}")
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.record is None: return self.adapt(input_ids, scores)
+        original = scores.clone()
+        scores = self.adapt(input_ids, scores)
+        self.record.add(input_ids, self.input_len, original, scores, self.alpha)
+        return scores
+
+    def adapt(self, input_ids, scores):
+        self.steps += 1
+        if self.metrics is not None: self.step_metrics = self.metrics.add_step(rows=scores.shape[0])
+        prefixes = [tuple(row) for row in input_ids[:,self.input_len:].tolist()]
+        if self.bridge is not None: self.update_buffers(prefixes)
         # Find possible tokens and form sentences from them
+        if self.stop_when_satisfied and self.classifiers: self.update_satisfaction(prefixes) # also on steps without scoring, so that the state follows every prefix
         entry, candidate_tokens = torch.where(~scores.isneginf())
-        if len(candidate_tokens.unique()) == 1: return scores
-        candidate_sequences = torch.cat([input_ids[entry,self.input_len:], candidate_tokens.unsqueeze(1)], dim=-1)
-        candidates = self.tokenizer.batch_decode(candidate_sequences, skip_special_tokens=True)
-        #candidates = [sent_tokenize(c)[-1] for c in candidates]
-        if self.timing: print(f"Decoding: {time.time()-start}")
+        if len(candidate_tokens.unique()) == 1 or not self.classifiers: return scores
+        rows = entry.unique()
+        active = self.scored_rows(rows, scores)
+        if self.stop_when_satisfied:
+            active = active[~self.satisfied[active].all(dim=1)]
+        self.count(rows, active)
+        skipped = rows[~torch.isin(rows, active)]
+        if len(skipped) and self.reuse_scores:
+            scores = self.reuse(skipped, entry, candidate_tokens, scores, prefixes)
+        if len(active) == 0: return scores
+        selected = torch.isin(entry, active)
+        entry, candidate_tokens = entry[selected], candidate_tokens[selected]
+        if self.step_metrics is not None: self.step_metrics.update(candidates=len(entry), scored_rows=len(active))
+        if self.bridge is not None:
+            with self.span("Bridging"):
+                tokenized_inputs = self.bridge.encode({i: self.buffers[prefix] for i, prefix in enumerate(prefixes)}, entry, candidate_tokens)
+        else:
+            with self.span("Decoding"):
+                candidate_sequences = torch.cat([input_ids[entry,self.input_len:], candidate_tokens.unsqueeze(1)], dim=-1)
+                candidates = self.tokenizer.batch_decode(candidate_sequences, skip_special_tokens=True)
+                #candidates = [sent_tokenize(c)[-1] for c in candidates]
+                tokenized_inputs = bert_tokenizer(candidates, return_tensors='pt', max_length=64, padding='max_length', truncation=True)
+                tokenized_inputs = {key: value.to(device) for key, value in tokenized_inputs.items()}
+        if self.step_metrics is not None: self.step_metrics["unique_lengths"] = len(tokenized_inputs['attention_mask'].sum(dim=1).unique())
 
         # Grammar scoring
-        start = time.time()
-        tokenized_inputs = bert_tokenizer(candidates, return_tensors='pt', max_length=64, padding='max_length', truncation=True)
-        tokenized_inputs = {key: value.to(device) for key, value in tokenized_inputs.items()}
-        encoded_inputs = bert_encoder(**tokenized_inputs) # encoding is the same for all classifiers
-        with torch.no_grad():
-            x = torch.cat(encoded_inputs.hidden_states, dim=-1)
-            grammar_scores = torch.vstack([clf.forward_bert(x, tokenized_inputs['attention_mask'])[0] for clf in self.classifiers.values()])
-        if self.timing: print(f"Scoring: {time.time()-start}")
+        runs = [not done for done in self.satisfied[active].all(dim=0).tolist()] if self.stop_when_satisfied else [True] * len(self.classifiers) # only constructs that some scored sequence still lacks
+        input_ids = tokenized_inputs['input_ids']
+        if self.triggers is not None: # candidates without a trigger cannot contain the construct, they score 0 without running its detector
+            masks = torch.stack([self.triggers.mask(nr, input_ids) if run else torch.zeros(len(input_ids), dtype=torch.bool, device=input_ids.device) for nr, run in zip(self.classifiers, runs)])
+        else:
+            masks = torch.tensor(runs, dtype=torch.bool, device=input_ids.device).unsqueeze(1).expand(-1, len(input_ids))
+        encoded = masks.any(dim=0) # candidates that at least one detector needs
+        grammar_scores = torch.zeros(len(self.classifiers), len(entry), device=device)
+        if encoded.any():
+            with self.span("Encoder"):
+                encoded_inputs = bert_encoder(**{key: value[encoded] for key, value in tokenized_inputs.items()}) # encoding is the same for all classifiers
+            with self.span("Heads"), torch.no_grad():
+                x = torch.cat(encoded_inputs.hidden_states, dim=-1)
+                attention_mask = tokenized_inputs['attention_mask'][encoded]
+                for j, clf in enumerate(self.classifiers.values()):
+                    rows = masks[j][encoded]
+                    if rows.all(): grammar_scores[j, encoded] = clf.forward_bert(x, attention_mask)[0]
+                    elif rows.any(): grammar_scores[j, masks[j]] = clf.forward_bert(x[rows], attention_mask[rows])[0]
             
-        # Adapt scores
-        start = time.time()
-        for i in entry.unique().cpu().tolist():
-            mask = entry==i
-            grammar_logits = (grammar_scores[:,mask] - grammar_scores[:,mask].mean(dim=1, keepdim=True)).max(dim=0).values
-            grammar_logits = torch.log(F.softmax(grammar_logits, dim=0))
-            scores[i,candidate_tokens[mask]] = (1-self.alpha)*scores[i,candidate_tokens[mask]] + self.alpha * grammar_logits
-
-        if self.timing: print(f"Score Adaptation: {time.time()-start}")
+        # Adapt scores: center per row and construct, take the best construct and blend
+        with self.span("Score Adaptation"):
+            centered = center_grammar_scores(grammar_scores, entry, scores.shape[0])
+            if self.stop_when_satisfied:
+                centered = centered.masked_fill(self.satisfied[entry].T, -float("inf"))
+            grammar_logits = centered.max(dim=0).values
+            if self.stop_when_satisfied or self.reuse_scores:
+                for i in entry.unique().cpu().tolist():
+                    mask = entry==i
+                    if self.stop_when_satisfied: self.previous[prefixes[i]] = (candidate_tokens[mask], grammar_scores[:,mask])
+                    if self.reuse_scores: self.last_logits[prefixes[i]] = (candidate_tokens[mask], grammar_logits[mask])
+                if self.reuse_scores: # keep the states current sequences can still fall back to
+                    self.last_logits = {key: value for key, value in self.last_logits.items() if any(prefix[:len(key)] == key for prefix in prefixes)}
+            scores = self.fuse(scores, entry, candidate_tokens, grammar_logits)
         return scores
 
-def decoding(model, tokenizer, prompt, do_sample=False, constrained=True, alpha=0.99, classifiers={}):
-    model_input=tokenizer(prompt, return_tensors="pt").to(device)
+class DecodingRecord():
+    """
+    Candidates, language model scores and grammar logits of every constrained decoding step keyed by prompt and generated prefix.
+    The processor blends linearly, so the grammar logits are recovered from the blended scores and decoding can be replayed for other alphas.
+    The scoring settings the grammar logits depend on are stored with the steps, replays with other settings are rejected.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        saved = torch.load(path) if path and os.path.exists(path) else {}
+        if "steps" in saved and "config" in saved:
+            self.steps, self.config = saved["steps"], saved["config"]
+        else: # records saved without their settings
+            self.steps, self.config = saved, None
+
+    @staticmethod
+    def settings(schedule="every", score_every=1, reuse_scores=False, token_bridge=False, stop_when_satisfied=False, **kwargs):
+        return {"schedule": schedule, "score_every": score_every, "reuse_scores": reuse_scores, "token_bridge": token_bridge, "stop_when_satisfied": stop_when_satisfied}
+
+    def check(self, settings):
+        if self.config is not None and self.config != settings:
+            raise ValueError(f"Decoding record was made with {self.config}, not {settings}")
+
+    def bind(self, alpha, settings):
+        """
+        Called before recording a decoding run, at alpha=0 the grammar logits vanish from the scores and cannot be recovered
+        """
+        if alpha == 0: raise ValueError("Decoding cannot be recorded with alpha=0")
+        self.check(settings)
+        self.config = settings
+
+    @staticmethod
+    def key(prompt_ids, prefix):
+        return hashlib.sha1(str(list(prompt_ids)).encode()).hexdigest(), tuple(prefix)
+
+    def add(self, input_ids, input_len, original, scores, alpha):
+        for i in range(input_ids.shape[0]):
+            candidates = (~original[i].isneginf()).nonzero().flatten()
+            lm_scores = original[i, candidates].float()
+            grammar_logits = (scores[i, candidates].float() - (1-alpha)*lm_scores) / alpha
+            self.steps[self.key(input_ids[i,:input_len].tolist(), input_ids[i,input_len:].tolist())] = (candidates.cpu(), lm_scores.cpu(), grammar_logits.cpu())
+
+    def get(self, prompt_ids, prefix):
+        return self.steps.get(self.key(prompt_ids, prefix))
+
+    def save(self, path=None):
+        torch.save({"config": self.config, "steps": self.steps}, path if path else self.path)
+
+def replay_decoding(model, tokenizer, prompt, alpha, record, max_new_tokens=128, **kwargs):
+    """
+    Greedy constrained decoding from recorded steps, the model and detectors only run from the point where the trajectory leaves the record.
+    Satisfaction and reused scores are state of the processor that the record does not hold, so runs with stop_when_satisfied or reuse_scores cannot be replayed.
+    """
+    settings = DecodingRecord.settings(**kwargs)
+    record.check(settings)
+    if settings["stop_when_satisfied"] or settings["reuse_scores"] or (record.config and (record.config["stop_when_satisfied"] or record.config["reuse_scores"])):
+        raise ValueError("Decoding with stop_when_satisfied or reuse_scores cannot be replayed")
+    prompt_ids = tokenizer(prompt).input_ids
+    eos_token_id = {tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<|eot_id|>")}
+    prefix = []
+    while len(prefix) < max_new_tokens:
+        step = record.get(prompt_ids, prefix)
+        if step is None:
+            return decoding(model, tokenizer, prompt, alpha=alpha, record=record if alpha > 0 else None, prefix=prefix, **kwargs)
+        candidates, lm_scores, grammar_logits = step
+        prefix.append(candidates[((1-alpha)*lm_scores + alpha*grammar_logits).argmax()].item())
+        if prefix[-1] in eos_token_id: break
+    return tokenizer.decode(prefix, skip_special_tokens=True)
+
+class HiddenStateProbe(torch.nn.Module):
+    """
+    Lightweight grammar detector on the generator's last hidden state of a prefix and the input embedding of a candidate token
+    """
+    def __init__(self, hidden_size, embedding_size, hidden_dim=32):
+        super().__init__()
+        self.state = torch.nn.Linear(hidden_size, hidden_dim)
+        self.token = torch.nn.Linear(embedding_size, hidden_dim, bias=False)
+        self.relu = torch.nn.ReLU()
+        self.output = torch.nn.Linear(hidden_dim, 1)
+        self.sigmoid = torch.nn.Sigmoid()
+
+    def forward(self, states, embeddings):
+        x = self.relu(self.state(states) + self.token(embeddings))
+        return self.sigmoid(self.output(x)).flatten()
+
+def score_prefixes(tokenizer, teachers, ids):
+    """
+    Scores every prefix of a token sequence with the BERT-based detectors, the targets the hidden state probes are distilled from
+    """
+    prefixes = tokenizer.batch_decode([ids[:t+1] for t in range(len(ids))], skip_special_tokens=True)
+    tokenized_inputs = bert_tokenizer(prefixes, return_tensors='pt', max_length=64, padding='max_length', truncation=True)
+    tokenized_inputs = {key: value.to(device) for key, value in tokenized_inputs.items()}
+    with torch.no_grad():
+        x = torch.cat(bert_encoder(**tokenized_inputs).hidden_states, dim=-1)
+        return {nr: teacher.forward_bert(x, tokenized_inputs['attention_mask'])[0] for nr, teacher in teachers.items()}
+
+def distill_probes(model, tokenizer, teachers, texts, num_epochs=3, lr=1e-3, batch_size=256, hidden_dim=32):
+    """
+    Trains one hidden state probe per teacher detector on all token positions of the given texts
+    """
+    model.eval()
+    states, embeddings, labels = [], [], {nr: [] for nr in teachers}
+    for text in tqdm(texts, desc="Distill"):
+        ids = tokenizer(text, return_tensors="pt").input_ids.to(device)
+        if ids.shape[1] < 2: continue
+        with torch.no_grad():
+            outputs = model(ids, output_hidden_states=True)
+        # the state after token t predicts the construct in the sequence extended by token t+1
+        states.append(outputs.hidden_states[-1][0, :-1].float().cpu())
+        embeddings.append(model.get_input_embeddings()(ids[0, 1:]).float().cpu())
+        for nr, values in score_prefixes(tokenizer, teachers, ids[0, 1:].tolist()).items():
+            labels[nr].append(values.cpu())
+    states, embeddings = torch.cat(states), torch.cat(embeddings)
+
+    probes = {}
+    for nr in teachers:
+        probe = HiddenStateProbe(states.shape[1], embeddings.shape[1], hidden_dim).to(device)
+        optimizer = torch.optim.AdamW(probe.parameters(), lr)
+        dataloader = DataLoader(TensorDataset(states, embeddings, torch.cat(labels[nr])), batch_size=batch_size, shuffle=True)
+        for epoch in range(num_epochs):
+            for batch_states, batch_embeddings, batch_labels in dataloader:
+                loss = F.binary_cross_entropy(probe(batch_states.to(device), batch_embeddings.to(device)), batch_labels.to(device))
+                loss.backward()
+                optimizer.step()
+                optimizer.zero_grad()
+        probes[nr] = probe.eval()
+    return probes
+
+def save_probe(probe, nr, dir="hidden_probes"):
+    """
+    Save a hidden state probe to the specified subdirectory in the models directory
+    """
+    torch.save({"state_dict": probe.state_dict(), "hidden_size": probe.state.in_features, "embedding_size": probe.token.in_features, "hidden_dim": probe.output.in_features}, f'../models/{dir}/{nr}.pth')
+
+def load_probe(nr, dir="hidden_probes"):
+    """
+    Load a hidden state probe from the specified subdirectory in the models directory
+    """
+    checkpoint = torch.load(f'../models/{dir}/{nr}.pth')
+    probe = HiddenStateProbe(checkpoint["hidden_size"], checkpoint["embedding_size"], checkpoint["hidden_dim"])
+    probe.load_state_dict(checkpoint["state_dict"])
+    return probe.to(device).eval()
+
+class ProbeLogitsProcessor(LogitsProcessor):
+    """
+    Grammar guidance from hidden state probes: the last hidden state is captured with a hook on the final norm, so scoring the candidates takes a few matmuls instead of an encoder pass
+    """
+    def __init__(self, model, probes, alpha):
+        super().__init__()
+        self.probes = probes
+        self.alpha = alpha
+        self.embeddings = model.get_input_embeddings()
+        self.hidden = None
+        self.hook = model.model.norm.register_forward_hook(self.capture)
+
+    def capture(self, module, inputs, output):
+        self.hidden = output[:, -1]
+
+    def close(self):
+        self.hook.remove()
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        entry, candidate_tokens = torch.where(~scores.isneginf())
+        if len(candidate_tokens.unique()) == 1: return scores
+        with torch.no_grad():
+            states = self.hidden[entry].float().to(device)
+            embeddings = self.embeddings(candidate_tokens.to(self.embeddings.weight.device)).float().to(device)
+            grammar_scores = torch.vstack([probe(states, embeddings) for probe in self.probes.values()])
+        grammar_logits = center_grammar_scores(grammar_scores, entry, scores.shape[0]).max(dim=0).values
+        return fuse_grammar_logits(scores, entry, candidate_tokens, grammar_logits, self.alpha)
+
+def decoding(model, tokenizer, prompt, do_sample=False, constrained=True, alpha=0.99, classifiers={}, prefix_cache=None, schedule="every", score_every=1, reuse_scores=False, token_bridge=False, probes=None, stop_when_satisfied=False, triggers=None, record=None, prefix=None, num_beams=1, num_return_sequences=1, metrics=None, stats=None, memo=None):
+    memo = generation_cache if memo is None else memo
+    key = None
+    if memo.db is not None and not do_sample and record is None and metrics is None: # records and metrics need the decoding steps
+        processors = {"alpha": alpha, "classifiers": {nr: module_fingerprint(classifier) for nr, classifier in classifiers.items()}, "probes": {nr: module_fingerprint(probe) for nr, probe in probes.items()} if probes else None,
+                      "schedule": schedule, "score_every": score_every, "reuse_scores": reuse_scores, "token_bridge": token_bridge, "stop_when_satisfied": stop_when_satisfied, "triggers": triggers.fingerprint(classifiers) if triggers is not None else None} if constrained else None
+        key = memo.key(model_fingerprint(model), prompt, function="decoding", prefix=prefix, num_beams=num_beams, num_return_sequences=num_return_sequences, processors=processors)
+        cached = memo.get(key)
+        if cached is not None:
+            if stats is not None and cached["stats"] is not None: stats.update(cached["stats"])
+            return cached["responses"][0] if num_return_sequences == 1 else cached["responses"]
+    with tracing.span("tokenization"):
+        model_input=tokenizer(prompt, return_tensors="pt").to(device)
     input_len = model_input.input_ids.shape[1]
+    if prefix: # continue from already generated tokens, e.g. when a replay leaves the record
+        prefix_ids = torch.tensor([prefix], device=device)
+        model_input['input_ids'] = torch.cat([model_input.input_ids, prefix_ids], dim=1)
+        model_input['attention_mask'] = torch.cat([model_input.attention_mask, torch.ones_like(prefix_ids)], dim=1)
+    cache_kwargs = {}
+    if prefix_cache is not None and num_beams == 1 and num_return_sequences == 1: # cache forks are not expanded to beams
+        _, cache_kwargs['past_key_values'] = prefix_cache.match([model_input.input_ids[0].tolist()])
 
     min_p = EpsilonLogitsWarper(epsilon=1e-3)
     top_k = TopKLogitsWarper(top_k=200)
-    gram = GrammarLogitsProcessor(tokenizer, classifiers, input_len, alpha)
+    if probes and constrained:
+        gram = ProbeLogitsProcessor(model, probes, alpha)
+    else:
+        if record is not None and constrained: record.bind(alpha, DecodingRecord.settings(schedule=schedule, score_every=score_every, reuse_scores=reuse_scores, token_bridge=token_bridge, stop_when_satisfied=stop_when_satisfied))
+        gram = GrammarLogitsProcessor(tokenizer, classifiers, input_len, alpha, schedule=schedule, score_every=score_every, reuse_scores=reuse_scores, token_bridge=token_bridge, stop_when_satisfied=stop_when_satisfied, triggers=triggers, record=record, metrics=metrics)
+        if prefix: gram.steps = len(prefix) # keeps the phase of the k schedule
     
     kwargs = {"logits_processor": [min_p, top_k, gram],
               "renormalize_logits": True} if constrained else {}
 
-    token_ids = model.generate(**model_input,
-                               max_new_tokens=128,
-                               pad_token_id=tokenizer.eos_token_id,
-                               eos_token_id=[tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<|eot_id|>")],
-                               num_beams=1,
-                               do_sample=do_sample,
-                               temperature=1 if do_sample else None,
-                               top_p=0.95 if do_sample else None,
-                               top_k=300 if do_sample else None,
-                               **kwargs)
-    return tokenizer.batch_decode(token_ids[:,input_len:], skip_special_tokens=True)[0]
\ No newline at end of file
+    try:
+        with tracing.span("generation"):
+            token_ids = model.generate(**model_input,
+                                       max_new_tokens=128 - len(prefix if prefix else []),
+                                       pad_token_id=tokenizer.eos_token_id,
+                                       eos_token_id=[tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<|eot_id|>")],
+                                       num_beams=num_beams,
+                                       num_return_sequences=num_return_sequences,
+                                       do_sample=do_sample,
+                                       temperature=1 if do_sample else None,
+                                       top_p=0.95 if do_sample else None,
+                                       top_k=300 if do_sample else None,
+                                       **cache_kwargs,
+                                       **kwargs)
+    finally:
+        if isinstance(gram, ProbeLogitsProcessor): gram.close()
+    if stats is not None and hasattr(gram, "stats"): stats.update(gram.stats)
+    responses = tokenizer.batch_decode(token_ids[:,input_len:], skip_special_tokens=True)
+    if key is not None: memo.put_many([(key, {"responses": responses, "stats": gram.stats if hasattr(gram, "stats") else None})])
+    return responses[0] if num_return_sequences == 1 else responses
@@ -0,0 +1,144 @@
+# This module offers the shared work-queue runner that generates responses for the test sets of tasks 1 to 3
+
+import os
+import time
+import asyncio
+import pandas as pd
+from tqdm import tqdm
+from pandas.testing import assert_frame_equal
+
+import api
+import models
+import tracing
+import journal
+import serving
+
+def load_generator(model_name):
+    if "FT" in model_name: return models.load_generator(model_name)
+    return models.load_generator("meta-llama/Meta-Llama-3-8B-Instruct")
+
+def strategy(args):
+    if args.model == "gpt35": return "api"
+    if args.best_of_n: return "best_of_n"
+    if args.decoding: return "decoding"
+    return "generate"
+
+class TaskRunner():
+    """
+    Plans the pending cases of a test set, executes them in batches with the backend of the strategy and streams the results into a result journal
+    """
+    def __init__(self, args, data_dir, build_prompt, get_constraints, cols_to_assert):
+        self.args = args
+        self.data_dir = data_dir
+        self.build_prompt = build_prompt
+        self.get_constraints = get_constraints
+        self.cols_to_assert = cols_to_assert
+        self.input_file = f'{data_dir}/{args.input_file}'
+        self.output_file = f'{data_dir}/{args.output_file.replace("%model%", args.label if args.label else args.model)}'
+        self.strategy = strategy(args)
+        self.batch_size = args.batch_size if self.strategy in ("api", "generate") else 1 # constrained cases bring their own detectors
+        self.time_column = "time" if self.batch_size == 1 else "amortized_time" # batch time divided by batch size, not comparable to per-case times
+        self.prompt_kwargs = {}
+        self.model, self.tokenizer, self.prefix_cache, self.record, self.metrics, self.triggers, self.batcher = None, None, None, None, None, None, None
+        if "llama" in args.model:
+            self.model, self.tokenizer = load_generator(args.model)
+            self.prefix_cache = models.PrefixCache(self.model) if args.prefix_cache else None
+            self.batcher = serving.ContinuousBatcher(self.model, self.tokenizer, max_batch_size=args.batch_size) if args.continuous_batching and self.strategy == "generate" else None
+            self.record = models.DecodingRecord(args.record_file) if args.record_file else None
+            self.metrics = models.DecodingMetrics() if args.metrics_file else None
+            self.triggers = models.TriggerIndex.load(args.triggers) if args.triggers else None
+            if self.triggers is not None: self.triggers.check("partial_sequences") # the detectors gated during decoding
+            self.prompt_kwargs = {"apply_chat_template": self.tokenizer.apply_chat_template, "system_msg": True}
+        self.client = api.AsyncChatClient(max_concurrency=args.batch_size) if self.strategy == "api" else None
+
+    def load(self):
+        if os.path.exists(self.output_file):
+            testset = pd.read_json(self.output_file)
+            assert_frame_equal(testset[self.cols_to_assert], pd.read_json(self.input_file)[self.cols_to_assert])
+            return testset
+        testset = pd.read_json(self.input_file)
+        testset['responses'] = [[]] * len(testset)
+        if self.args.decoding: testset['skipped_steps'] = [None] * len(testset)
+        if self.args.time: testset[self.time_column] = [0.] * len(testset)
+        return testset
+
+    def plan(self, testset):
+        """
+        Pending cases in the shuffled order of the scripts, grouped into batches that one backend call executes
+        """
+        remaining = testset[testset['responses'].apply(len)==0]
+        pending = [self.build_prompt(case, **self.prompt_kwargs) for _, case in remaining.sample(frac=1., random_state=26).head(self.args.max_rows).iterrows()]
+        return [pending[i:i+self.batch_size] for i in range(0, len(pending), self.batch_size)]
+
+    def execute(self, batch, testset):
+        """
+        Returns one list of responses per case, empty lists for cases that failed and stay pending
+        """
+        if self.strategy == "api":
+            return [[response for response in responses if response] for responses in self.client.run([{"messages": case["messages"][:-1], "n": self.args.n_responses, "temperature": 0} for case in batch])]
+        if self.strategy == "generate" and self.batcher is not None: # cases leave the batch at their terminator instead of waiting for the longest one
+            return [[response] for response in asyncio.run(serving.generate_concurrently(self.batcher, [case['prompt'] for case in batch]))]
+        if self.strategy == "generate":
+            responses = models.generate(self.model, self.tokenizer, [case['prompt'] for case in batch], batch_size=len(batch), prefix_cache=self.prefix_cache, truncate=False)
+            return [[response] for response in ([responses] if isinstance(responses, str) else responses)]
+        case = batch[0]
+        constraints = self.get_constraints(case)
+        if self.strategy == "best_of_n":
+            classifiers = {nr: models.load_classifier(nr, "corpus_training") for nr in constraints}
+            return [[models.best_of_n(self.model, self.tokenizer, case['prompt'], classifiers, n=self.args.best_of_n)]]
+        if self.args.probes:
+            probes, classifiers = {nr: models.load_probe(nr) for nr in constraints}, {}
+        else:
+            probes, classifiers = None, {nr: models.load_classifier(nr, "partial_sequences") for nr in constraints}
+        stats = {}
+        if self.metrics is not None: self.metrics.start_case(case.name)
+        response = models.decoding(self.model, self.tokenizer, case['prompt'], constrained=True, classifiers=classifiers, probes=probes, alpha=self.args.alpha, prefix_cache=self.prefix_cache,
+                                   schedule=self.args.schedule, score_every=self.args.score_every, reuse_scores=self.args.reuse_scores, token_bridge=self.args.token_bridge, stop_when_satisfied=self.args.stop_when_satisfied, triggers=self.triggers,
+                                   num_beams=self.args.num_beams, record=self.record, metrics=self.metrics, stats=stats)
+        if stats: testset.at[case.name, 'skipped_steps'] = stats['skipped_steps'] / max(1, stats['scored_steps'] + stats['skipped_steps'])
+        return [[response]]
+
+    def finish(self):
+        """
+        Exports the decoding metrics and saves the decoding record of all cases once, rewriting them after every case would be quadratic in the number of steps
+        """
+        if self.record is not None: self.record.save()
+        if self.triggers is not None: print(f"Trigger index skipped {sum(self.triggers.skipped.values())} of {sum(self.triggers.checked.values())} detector runs on candidates")
+        if self.metrics is not None:
+            self.metrics.to_json(f'{self.data_dir}/{self.args.metrics_file}.json')
+            self.metrics.to_chrome_trace(f'{self.data_dir}/{self.args.metrics_file}_trace.json')
+
+    def run(self):
+        if self.args.trace: tracing.tracer.enable() # before planning, which builds the prompts
+        testset = self.load()
+        store = journal.ResultJournal(self.output_file)
+        store.apply(testset) # results of an interrupted run
+        batches = self.plan(testset)
+        total = sum(len(batch) for batch in batches)
+        print(f"{total} pending cases in {len(batches)} batches with strategy {self.strategy}")
+        start, done = time.time(), 0
+        progress = tqdm(total=total, unit="case")
+        try:
+            for batch in batches:
+                batch_start = time.time()
+                with tracing.tracer.case(len(batch)):
+                    with tracing.span("batch"):
+                        results = self.execute(batch, testset)
+                    for case, responses in zip(batch, results):
+                        if not responses: continue
+                        testset.at[case.name, 'responses'] = responses
+                        if self.args.time: testset.at[case.name, self.time_column] = (time.time() - batch_start) / len(batch)
+                        with tracing.span("file_io"): store.append(case.name, {column: testset.at[case.name, column] for column in ["responses", self.time_column, "skipped_steps"] if column in testset.columns})
+                done += len(batch)
+                progress.update(len(batch))
+                rate = done / (time.time() - start)
+                progress.set_postfix_str(f"{rate:.2f} cases/s, ETA {(total - done) / rate:.0f}s")
+        finally: # interrupted runs keep what was measured so far
+            progress.close()
+            self.finish()
+        with tracing.span("file_io"): store.compact(testset)
+        elapsed = time.time() - start
+        print(f"{done} cases in {elapsed:.1f}s ({(done / elapsed if elapsed else 0.):.2f} cases/s)")
+        if models.generation_cache.db is not None: print(models.generation_cache.summary())
+        tracing.tracer.report(self.output_file.replace(".json", "_trace.json"))
+        return testset
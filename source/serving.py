@@ -0,0 +1,243 @@
+# This module offers components to serve grammar-controlled responses to requests arriving one at a time
+
+import asyncio
+import time
+from collections import deque, OrderedDict
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+
+import models
+import helpers
+from models import device
+
+def to_legacy(past):
+    return past.to_legacy_cache() if isinstance(past, DynamicCache) else past
+
+def pad_past(past, length):
+    """
+    Left-pads the key/value states of a cache to the given sequence length
+    """
+    return tuple((F.pad(key, (0, 0, length - key.shape[2], 0)), F.pad(value, (0, 0, length - value.shape[2], 0))) for key, value in past)
+
+class ContinuousBatcher():
+    """
+    Iteration-level scheduler around a causal LM: requests join the running batch after every decoding step and leave it as soon as they hit a terminator
+    """
+    def __init__(self, model, tokenizer, max_batch_size=16, max_new_tokens=128, eos_token_id=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        if eos_token_id is None: eos_token_id = [tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<|eot_id|>")]
+        self.eos_token_id = set(eos_token_id) if isinstance(eos_token_id, list) else {eos_token_id}
+        self.waiting = deque()
+        self.running = [] # one dict per row of the batch
+        self.past = None # legacy cache with one row per running request
+        self.attention_mask = None
+        self.wake = None
+        self.stats = {"requests": 0, "steps": 0, "tokens": 0, "time": 0.}
+
+    async def submit(self, prompt, max_new_tokens=None):
+        """
+        Queues one prompt and waits for its decoded response
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append({"prompt": prompt, "max_new_tokens": max_new_tokens or self.max_new_tokens, "future": future})
+        if self.wake is not None: self.wake.set()
+        return await future
+
+    async def serve(self):
+        """
+        Runs the scheduling loop, decoding steps are executed in a worker thread to keep accepting submissions
+        """
+        self.wake = asyncio.Event()
+        while True:
+            if not self.running and not self.waiting:
+                await self.wake.wait()
+                self.wake.clear()
+            for request, response in await asyncio.to_thread(self.iterate):
+                if not request["future"].done(): request["future"].set_result(response)
+
+    def iterate(self):
+        start = time.time()
+        finished = []
+        while self.waiting and len(self.running) < self.max_batch_size:
+            finished += self.admit(self.waiting.popleft())
+        if self.running:
+            finished += self.step()
+        self.stats["time"] += time.time() - start
+        return finished
+
+    def admit(self, request):
+        """
+        Prefills a new request and merges its cache into the running batch, prompts are not truncated to keep the assistant header at their end
+        """
+        input_ids = self.tokenizer(request["prompt"], return_tensors="pt").input_ids.to(device)
+        with torch.no_grad():
+            outputs = self.model(input_ids, use_cache=True)
+        past = to_legacy(outputs.past_key_values)
+        request.update({"tokens": [outputs.logits[0, -1].argmax().item()], "length": input_ids.shape[1]})
+        self.stats["requests"] += 1
+        self.stats["tokens"] += 1
+        if self.is_finished(request): return [(request, self.decode(request))]
+
+        mask = torch.ones(1, input_ids.shape[1], dtype=torch.long, device=device)
+        if self.past is None:
+            self.past, self.attention_mask = past, mask
+        else:
+            length = max(self.attention_mask.shape[1], mask.shape[1])
+            self.past = tuple((torch.cat([key, new_key]), torch.cat([value, new_value])) for (key, value), (new_key, new_value) in zip(pad_past(self.past, length), pad_past(past, length)))
+            self.attention_mask = torch.cat([F.pad(self.attention_mask, (length - self.attention_mask.shape[1], 0)), F.pad(mask, (length - mask.shape[1], 0))])
+        self.running.append(request)
+        return []
+
+    def step(self):
+        """
+        Runs one decoding step for all running requests and evicts finished ones
+        """
+        input_ids = torch.tensor([[request["tokens"][-1]] for request in self.running], device=device)
+        position_ids = torch.tensor([[request["length"] + len(request["tokens"]) - 1] for request in self.running], device=device)
+        self.attention_mask = F.pad(self.attention_mask, (0, 1), value=1)
+        with torch.no_grad():
+            outputs = self.model(input_ids, attention_mask=self.attention_mask, position_ids=position_ids, past_key_values=DynamicCache.from_legacy_cache(self.past), use_cache=True)
+        self.past = to_legacy(outputs.past_key_values)
+        next_tokens = outputs.logits[:, -1].argmax(dim=-1).tolist()
+        self.stats["steps"] += 1
+        self.stats["tokens"] += len(next_tokens)
+
+        finished, keep = [], []
+        for i, (request, token) in enumerate(zip(self.running, next_tokens)):
+            request["tokens"].append(token)
+            if self.is_finished(request): finished.append((request, self.decode(request)))
+            else: keep.append(i)
+        if len(keep) < len(self.running):
+            self.running = [self.running[i] for i in keep]
+            index = torch.tensor(keep, dtype=torch.long, device=device)
+            self.past = tuple((key[index], value[index]) for key, value in self.past) if keep else None
+            self.attention_mask = self.attention_mask[index] if keep else None
+            if keep: self.trim()
+        return finished
+
+    def trim(self):
+        """
+        Drops leading cache positions that are padding for every remaining request
+        """
+        offset = int((self.attention_mask.sum(dim=0) == 0).long().cumprod(dim=0).sum().item())
+        if offset == 0: return
+        self.past = tuple((key[:, :, offset:], value[:, :, offset:]) for key, value in self.past)
+        self.attention_mask = self.attention_mask[:, offset:]
+
+    def is_finished(self, request):
+        return request["tokens"][-1] in self.eos_token_id or len(request["tokens"]) >= request["max_new_tokens"]
+
+    def decode(self, request):
+        return self.tokenizer.decode(request["tokens"], skip_special_tokens=True)
+
+    def throughput(self):
+        return self.stats["tokens"] / self.stats["time"] if self.stats["time"] else 0.
+
+async def generate_concurrently(batcher, prompts, max_new_tokens=None):
+    """
+    Submits all prompts to a continuous batcher and collects the responses in order
+    """
+    server = asyncio.create_task(batcher.serve())
+    try:
+        return await asyncio.gather(*[batcher.submit(prompt, max_new_tokens) for prompt in prompts])
+    finally:
+        server.cancel()
+
+def crop_past(past, length):
+    return tuple((key[:, :, :length], value[:, :, :length]) for key, value in past)
+
+class ConversationSession():
+    """
+    Keeps the key/value states of the rendered dialog history so that each turn only encodes the tokens that changed
+    """
+    def __init__(self, model, tokenizer, build_prompt=None, max_new_tokens=128, eos_token_id=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.build_prompt = build_prompt if build_prompt else lambda context: helpers.get_generation_prompt({"context": context, "response": ""}, tokenizer.apply_chat_template, unconstrained=True, system_msg=True)['prompt']
+        self.max_new_tokens = max_new_tokens
+        if eos_token_id is None: eos_token_id = [tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<|eot_id|>")]
+        self.eos_token_id = set(eos_token_id) if isinstance(eos_token_id, list) else {eos_token_id}
+        self.context = []
+        self.ids = [] # tokens covered by the cache
+        self.past = None
+        self.last_used = time.time()
+        self.stats = {"turns": 0, "reused_tokens": 0, "encoded_tokens": 0, "time_to_first_token": []}
+
+    def release(self):
+        self.ids, self.past = [], None
+
+    def forward(self, ids):
+        with torch.no_grad():
+            outputs = self.model(torch.tensor([ids], device=device), past_key_values=DynamicCache.from_legacy_cache(self.past) if self.past else None, use_cache=True)
+        self.past = to_legacy(outputs.past_key_values)
+        self.ids = self.ids + list(ids)
+        return outputs.logits[0, -1]
+
+    def reply(self, utterance):
+        """
+        Appends the learner's turn to the dialog and generates the next response incrementally
+        """
+        start = time.time()
+        self.last_used = start
+        self.context.append(utterance)
+        ids = self.tokenizer(self.build_prompt(self.context)).input_ids
+        reused = min(models.common_prefix_length([self.ids, ids]), len(ids) - 1) if self.past else 0
+        if self.past: self.past, self.ids = crop_past(self.past, reused), self.ids[:reused]
+        logits = self.forward(ids[reused:])
+        self.stats["turns"] += 1
+        self.stats["reused_tokens"] += reused
+        self.stats["encoded_tokens"] += len(ids) - reused
+        self.stats["time_to_first_token"].append(time.time() - start)
+
+        tokens = []
+        while True:
+            tokens.append(logits.argmax().item())
+            if tokens[-1] in self.eos_token_id or len(tokens) >= self.max_new_tokens: break
+            logits = self.forward(tokens[-1:])
+        response = helpers.parse_response(self.tokenizer.decode(tokens, skip_special_tokens=True).strip())
+        self.context.append(response)
+        return response
+
+class SessionStore():
+    """
+    Holds conversation sessions with caps on the number of sessions and cached tokens, idle sessions release their cache first
+    """
+    def __init__(self, model, tokenizer, max_sessions=64, max_cached_tokens=65536, idle_timeout=600, **session_kwargs):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_sessions = max_sessions
+        self.max_cached_tokens = max_cached_tokens
+        self.idle_timeout = idle_timeout
+        self.session_kwargs = session_kwargs
+        self.sessions = OrderedDict()
+
+    def get(self, session_id):
+        if session_id not in self.sessions:
+            self.sessions[session_id] = ConversationSession(self.model, self.tokenizer, **self.session_kwargs)
+        self.sessions.move_to_end(session_id)
+        return self.sessions[session_id]
+
+    def reply(self, session_id, utterance):
+        response = self.get(session_id).reply(utterance)
+        self.evict()
+        return response
+
+    def cached_tokens(self):
+        return sum(len(session.ids) for session in self.sessions.values())
+
+    def evict(self):
+        now = time.time()
+        for session in self.sessions.values():
+            if now - session.last_used > self.idle_timeout: session.release()
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+        for session in list(self.sessions.values())[:-1]: # least recently used first, keep the active one
+            if self.cached_tokens() <= self.max_cached_tokens: break
+            session.release()
+
+    def end(self, session_id):
+        self.sessions.pop(session_id, None)
@@ -0,0 +1,95 @@
+# This module offers opt-in tracing of the stages of the generation and evaluation pipelines
+
+import os
+import time
+import json
+import resource
+import functools
+from contextlib import contextmanager
+import numpy as np
+
+def peak_rss():
+    """
+    Peak resident set size of the process in bytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class Tracer():
+    """
+    Records wall time, CPU time and peak RSS of named pipeline stages, nested stages are measured inclusively
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.spans = {}
+        self.cases = 0
+        self.started = time.perf_counter()
+
+    def enable(self):
+        """
+        Starts a new run, previously recorded spans are discarded
+        """
+        self.enabled = True
+        self.spans = {}
+        self.cases = 0
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def span(self, stage):
+        if not self.enabled:
+            yield
+            return
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.spans.setdefault(stage, []).append({"wall": time.perf_counter() - wall, "cpu": time.process_time() - cpu, "peak_rss": peak_rss()})
+
+    @contextmanager
+    def case(self, n=1):
+        """
+        Measures the work of n cases that run together, e.g. one batch
+        """
+        with self.span("case"):
+            yield
+        self.cases += n
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        stages = {}
+        for stage, records in self.spans.items():
+            wall = np.array([record["wall"] for record in records])
+            stages[stage] = {"count": len(records),
+                             "wall_total": wall.sum(),
+                             "wall_p50": np.percentile(wall, 50),
+                             "wall_p95": np.percentile(wall, 95),
+                             "cpu_total": sum(record["cpu"] for record in records),
+                             "peak_rss": max(record["peak_rss"] for record in records)}
+        return {"cases": self.cases, "elapsed": elapsed, "cases_per_second": self.cases / elapsed if elapsed else 0., "stages": stages}
+
+    def report(self, path=None):
+        """
+        Prints the throughput and the per-stage statistics and optionally saves them as JSON
+        """
+        if not self.enabled: return
+        summary = self.summary()
+        print(f"{summary['cases']} cases in {summary['elapsed']:.1f}s ({summary['cases_per_second']:.3f} cases/s)")
+        for stage, stats in sorted(summary["stages"].items(), key=lambda item: -item[1]["wall_total"]):
+            print(f"{stage:>20}: n={stats['count']:<6} total={stats['wall_total']:.2f}s p50={stats['wall_p50']:.3f}s p95={stats['wall_p95']:.3f}s cpu={stats['cpu_total']:.2f}s peak_rss={stats['peak_rss']/2**20:.0f}MB")
+        if path:
+            with open(path, 'w') as f:
+                json.dump(summary, f)
+
+tracer = Tracer(enabled=os.getenv("TRACE", "") not in ("", "0"))
+span = tracer.span
+
+def traced(stage):
+    """
+    Decorator that records every call of a function as the given stage
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
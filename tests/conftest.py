@@ -0,0 +1,8 @@
+# The source modules expect the environment of the scripts: a .env file, the model cache variables and the source directory on the path
+
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../source'))
+os.environ.setdefault('SLURM_JOB_ID', 'local')
+os.environ.setdefault('FAST_CACHE_DIR', os.getenv('CACHE_DIR', ''))
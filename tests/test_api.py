@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import socket
+import asyncio
+import subprocess
+import pytest
+pytest.importorskip("openai")
+pytest.importorskip("requests")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+import api
+
+script = os.path.join(os.path.dirname(__file__), '../scripts/mock_openai_server.py')
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+def start_server(*server_args):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, script, "--port", str(port), "--latency", "0.01", "--echo", *server_args], stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(("localhost", port), timeout=0.1).close()
+            return server, f"http://localhost:{port}/v1"
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    pytest.fail("mock server did not start")
+
+@pytest.fixture
+def flaky_server():
+    server, url = start_server("--rate_limit_rate", "0.2", "--error_rate", "0.2")
+    yield url
+    server.kill()
+
+def requests_for(n):
+    return [{"messages": [{"role": "user", "content": f"request {i}"}], "temperature": 0} for i in range(n)]
+
+def test_results_keep_request_order_through_retries(flaky_server):
+    client = api.AsyncChatClient(max_concurrency=8, rpm=100000, tpm=10000000, max_retries=20, base_delay=0.01, max_delay=0.05, base_url=flaky_server, api_key="test")
+    results = client.run(requests_for(40))
+    assert results == [[f"request {i}"] for i in range(40)]
+    assert client.stats["retries"] > 0
+    assert client.stats["failures"] == 0
+    assert client.stats["requests"] == 40 + client.stats["retries"]
+
+def test_exhausted_retries_return_empty_completions():
+    server, url = start_server("--error_rate", "1")
+    try:
+        client = api.AsyncChatClient(max_retries=2, base_delay=0.01, max_delay=0.01, base_url=url, api_key="test")
+        assert client.run(requests_for(3)) == [[""]] * 3
+        assert client.stats == {"requests": 9, "retries": 6, "failures": 3}
+    finally:
+        server.kill()
+
+def test_run_inside_running_event_loop(flaky_server):
+    client = api.AsyncChatClient(max_retries=20, base_delay=0.01, max_delay=0.05, base_url=flaky_server, api_key="test")
+    async def notebook_cell(): # Jupyter runs cells inside an event loop
+        return client.run(requests_for(4))
+    assert asyncio.run(notebook_cell()) == [[f"request {i}"] for i in range(4)]
@@ -0,0 +1,59 @@
+import pytest
+torch = pytest.importorskip("torch")
+models = pytest.importorskip("models")
+
+def single_candidate(token, vocab_size=10):
+    scores = torch.full((1, vocab_size), -float("inf"))
+    scores[0, token] = 0.
+    return scores
+
+def processor():
+    # no detector runs on single-candidate steps, so the classifiers are placeholders
+    return models.GrammarLogitsProcessor(None, {1: None, 2: None}, input_len=2, alpha=0.5, stop_when_satisfied=True)
+
+def test_satisfaction_survives_single_candidate_steps():
+    gram = processor()
+    gram.satisfied_by_prefix = {(5,): torch.tensor([False, False], device=models.device)}
+    gram.previous = {(5,): (torch.tensor([7, 8], device=models.device), torch.tensor([[0.9, 0.1], [0.2, 0.3]], device=models.device))}
+    gram(torch.tensor([[0, 0, 5, 7]]), single_candidate(3))
+    assert gram.satisfied[0].tolist() == [True, False]
+    gram(torch.tensor([[0, 0, 5, 7, 3]]), single_candidate(4))
+    gram(torch.tensor([[0, 0, 5, 7, 3, 4]]), single_candidate(1))
+    assert gram.satisfied[0].tolist() == [True, False]
+
+def test_satisfaction_is_inherited_from_ancestor_prefix():
+    gram = processor()
+    gram.satisfied_by_prefix = {(5,): torch.tensor([False, True], device=models.device)}
+    gram.previous = {(5, 7): (torch.tensor([3], device=models.device), torch.tensor([[0.8], [0.1]], device=models.device))}
+    gram(torch.tensor([[0, 0, 5, 7, 3]]), single_candidate(4))
+    assert gram.satisfied[0].tolist() == [True, True]
+
+def test_record_rejects_alpha_zero_and_mismatched_replays():
+    record = models.DecodingRecord()
+    with pytest.raises(ValueError):
+        record.bind(0, models.DecodingRecord.settings())
+    record.bind(0.5, models.DecodingRecord.settings(schedule="word"))
+    with pytest.raises(ValueError):
+        models.replay_decoding(None, None, "prompt", 0.9, record)
+
+def test_trigger_lookup_leaves_runtime_counters_alone():
+    index = models.TriggerIndex({1: {7}})
+    input_ids = torch.tensor([[101, 7, 102], [101, 8, 102]])
+    assert index.contains(1, input_ids).tolist() == [True, False]
+    assert index.checked == {} and index.skipped == {}
+    index.mask(1, input_ids)
+    assert index.checked == {1: 2} and index.skipped == {1: 1}
+
+def test_trigger_index_keeps_its_detector_directory(tmp_path):
+    models.TriggerIndex({1: {7}, 2: None}, dir="partial_sequences").save(tmp_path / "index.json")
+    index = models.TriggerIndex.load(tmp_path / "index.json")
+    assert index.triggers == {1: {7}, 2: None}
+    index.check("partial_sequences")
+    with pytest.raises(ValueError):
+        index.check("corpus_training")
+
+def test_replay_rejects_stateful_settings():
+    record = models.DecodingRecord()
+    record.bind(0.5, models.DecodingRecord.settings(stop_when_satisfied=True))
+    with pytest.raises(ValueError):
+        models.replay_decoding(None, None, "prompt", 0.9, record, stop_when_satisfied=True)
@@ -0,0 +1,31 @@
+import pytest
+pd = pytest.importorskip("pandas")
+import journal
+
+def evaluated():
+    return pd.DataFrame({"responses": [["a"], ["b"], ["c"]], "Relevance": [None, None, None]})
+
+def test_compact_truncates_the_journal(tmp_path):
+    output_file = str(tmp_path / "model_eval.json")
+    store = journal.ResultJournal(output_file)
+    store.append(0, {"Relevance": 4})
+    store.compact(evaluated())
+    assert store.completed() == set()
+    assert pd.read_json(output_file).at[0, "Relevance"] == 4
+
+def test_rows_without_results_stay_pending_after_compaction(tmp_path):
+    output_file = str(tmp_path / "model_eval.json")
+    store = journal.ResultJournal(output_file)
+    store.append(1, {"positive_constraints": [True]}) # evaluated without response quality
+    store.compact(evaluated())
+    resumed = pd.read_json(output_file)
+    journal.ResultJournal(output_file).apply(resumed)
+    assert list(resumed[resumed['Relevance'].isna()].index) == [0, 1, 2]
+
+def test_interrupted_results_are_replayed(tmp_path):
+    output_file = str(tmp_path / "model.json")
+    store = journal.ResultJournal(output_file)
+    store.append(2, {"responses": ["d"]})
+    store.close()
+    resumed = journal.ResultJournal(output_file).apply(pd.DataFrame({"responses": [["a"], [], []]}))
+    assert list(resumed[resumed['responses'].apply(len)==0].index) == [1]
@@ -0,0 +1,11 @@
+import tracing
+
+def test_batched_cases_are_counted_around_the_work():
+    tracer = tracing.Tracer()
+    tracer.enable()
+    with tracer.case(3):
+        with tracer.span("batch"):
+            pass
+    summary = tracer.summary()
+    assert summary["cases"] == 3
+    assert summary["stages"]["case"]["count"] == 1 and summary["stages"]["batch"]["count"] == 1